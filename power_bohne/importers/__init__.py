@@ -1,4 +1,5 @@
 from .kraken import Importer as KrakenImporter
 from .mobile_spending_tracker import Importer as MobileSpendingTracker
+from .account_rules import AccountRules
 
-__all__ = ['KrakenImporter', 'MobileSpendingTracker']
+__all__ = ['KrakenImporter', 'MobileSpendingTracker', 'AccountRules']
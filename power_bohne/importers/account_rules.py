@@ -0,0 +1,60 @@
+import re
+from collections import namedtuple
+from typing import Iterable, Optional
+
+Rule = namedtuple('Rule', ['kind', 'pattern', 'account'])
+
+RULE_KINDS = ('exact', 'prefix', 'regex')
+
+
+class AccountRules:
+    '''
+    Ordered `(kind, pattern, account)` rules resolving a string to an account, the first matching
+    rule wins. `exact` compares the whole string, `prefix` its start and `regex` is anchored at the
+    start like `re.match`. Exact and prefix rules are dict lookups, regex rules are compiled on
+    their own (so flags, group names and backreferences behave as in `re`) and only those ordered
+    before the best dict hit are tried. Results are memoized per distinct input, so large rule sets
+    stay cheap per row. Has a dict-like `get` so it can be used in place of a plain mapping.
+    '''
+
+    def __init__(self, rules: Iterable[tuple[str, str, str]]):
+        self.rules = [Rule(*rule) for rule in rules]
+        # @dev pattern -> index of the first rule with it, later duplicates can never win
+        self.exact: dict[str, int] = {}
+        self.prefixes: dict[str, int] = {}
+        self.regexes: list[tuple[int, re.Pattern]] = []
+        for i, rule in enumerate(self.rules):
+            assert rule.kind in RULE_KINDS, f'Unknown rule kind {rule.kind!r}'
+            if rule.kind == 'exact':
+                self.exact.setdefault(rule.pattern, i)
+            elif rule.kind == 'prefix':
+                self.prefixes.setdefault(rule.pattern, i)
+            else:
+                self.regexes.append((i, re.compile(rule.pattern)))
+        self.prefix_lengths: list[int] = sorted({len(prefix) for prefix in self.prefixes})
+        self.memo: dict[str, Optional[str]] = {}
+
+    @classmethod
+    def from_dict(cls, accounts: dict[str, str]) -> 'AccountRules':
+        return cls(('exact', pattern, account) for pattern, account in accounts.items())
+
+    def match(self, value: str) -> Optional[Rule]:
+        best = self.exact.get(value, len(self.rules))
+        for length in self.prefix_lengths:
+            if length > len(value):
+                break
+            best = min(best, self.prefixes.get(value[:length], best))
+        for i, regex in self.regexes:
+            if i >= best:
+                break
+            if regex.match(value):
+                best = i
+                break
+        return self.rules[best] if best < len(self.rules) else None
+
+    def get(self, value: str, default: Optional[str] = None) -> Optional[str]:
+        if value not in self.memo:
+            rule = self.match(value)
+            self.memo[value] = None if rule is None else rule.account
+        account = self.memo[value]
+        return default if account is None else account
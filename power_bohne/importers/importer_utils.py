@@ -1,5 +1,18 @@
+import os
+import json
+import heapq
+import tempfile
+from bisect import bisect_left
+from contextlib import closing
 from collections import defaultdict
+from datetime import datetime
+from itertools import groupby
+from typing import Optional
+from toolz import partition_all
 from beancount.core.number import D
+from ..utils import FileCache, connect_sqlite, sqlite_transaction
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 
 class MissedInstanceTracker:
@@ -19,3 +32,140 @@ class MissedInstanceTracker:
 
     def __iter__(self):
         return iter(self.instances)
+
+
+class RefidCheckpoint:
+    '''
+    Persistent record of imported ledger groups: the latest processed time plus the sorted refids
+    seen up to it. Anything newer than `last_time` is new without a lookup, older groups are checked
+    by binary search over the sorted refids.
+    '''
+    LOCK_TIMEOUT = 60.0
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.last_time: Optional[datetime] = None
+        self.refids: list[str] = []
+        self.new_refids: set[str] = set()
+        self.new_last_time: Optional[datetime] = None
+        self.load()
+
+    @property
+    def full_path(self):
+        return os.path.join(FileCache.CACHE_FOLDER, self.fp)
+
+    def _read(self):
+        if not os.path.exists(self.full_path):
+            return None, []
+        with open(self.full_path, 'r') as f:
+            raw = json.load(f)
+        last_time = raw['last_time']
+        return (
+            None if last_time is None else datetime.strptime(last_time, TIME_FORMAT),
+            raw['refids']
+        )
+
+    def load(self):
+        self.last_time, self.refids = self._read()
+        self.new_refids = set()
+        self.new_last_time = None
+
+    def seen(self, refid: str, time: datetime) -> bool:
+        if self.last_time is None or time > self.last_time:
+            return False
+        i = bisect_left(self.refids, refid)
+        return i < len(self.refids) and self.refids[i] == refid
+
+    def add(self, refid: str, time: datetime):
+        self.new_refids.add(refid)
+        if self.new_last_time is None or time > self.new_last_time:
+            self.new_last_time = time
+
+    def save(self):
+        if not self.new_refids:
+            return
+        os.makedirs(os.path.dirname(self.full_path), exist_ok=True)
+        # merge with the file as it is now, locked so concurrent runs don't overwrite each other.
+        # @dev the write lock of a SQLite side file works on every platform, unlike flock
+        with closing(connect_sqlite(f'{self.full_path}.lock', self.LOCK_TIMEOUT)) as lock_conn, \
+                sqlite_transaction(lock_conn):
+            disk_last_time, disk_refids = self._read()
+            self.refids = list(merge_unique(disk_refids, self.refids, sorted(self.new_refids)))
+            self.last_time = max(filter(None, [disk_last_time, self.last_time, self.new_last_time]))
+            tmp_path = f'{self.full_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'last_time': self.last_time.strftime(TIME_FORMAT),
+                    'refids': self.refids
+                }, f)
+            os.replace(tmp_path, self.full_path)
+        self.new_refids = set()
+        self.new_last_time = None
+
+
+def merge_unique(*sorted_iterables):
+    last = None
+    for item in heapq.merge(*sorted_iterables):
+        if item != last:
+            yield item
+            last = item
+
+
+GROUPING_STRATEGIES = ('consecutive', 'hash', 'external')
+
+
+def group_consecutive(rows, key):
+    for group_key, group in groupby(rows, key):
+        yield group_key, list(group)
+
+
+def group_hashed(rows, key):
+    # @dev one linear pass, groups come out in order of first appearance
+    groups = defaultdict(list)
+    for row in rows:
+        groups[key(row)].append(row)
+    yield from groups.items()
+
+
+def group_external(rows, key, chunk_size=100_000):
+    '''
+    Sort-merge grouping for inputs that don't fit in memory: rows are spilled to sorted chunk files,
+    then streamed back through a k-way merge. Rows keep their input order within a group, groups
+    come out sorted by key.
+    '''
+    with tempfile.TemporaryDirectory(prefix='power-bohne-group-') as tmp_dir:
+        chunk_paths = []
+        for chunk_index, chunk in enumerate(partition_all(chunk_size, enumerate(rows))):
+            chunk_path = os.path.join(tmp_dir, f'{chunk_index}.jsonl')
+            with open(chunk_path, 'w', encoding='utf-8') as f:
+                for seq, row in sorted(chunk, key=lambda item: (key(item[1]), item[0])):
+                    f.write(json.dumps([key(row), seq, row]) + '\n')
+            chunk_paths.append(chunk_path)
+
+        chunk_files = [open(chunk_path, 'r', encoding='utf-8') for chunk_path in chunk_paths]
+        try:
+            merged = heapq.merge(*(map(json.loads, f) for f in chunk_files))
+            for group_key, items in groupby(merged, lambda item: item[0]):
+                yield group_key, [row for _, _, row in items]
+        finally:
+            for f in chunk_files:
+                f.close()
+
+
+def group_rows(rows, key, strategy='consecutive', chunk_size=100_000):
+    assert strategy in GROUPING_STRATEGIES, f'Unknown grouping strategy {strategy!r}'
+    if strategy == 'consecutive':
+        return group_consecutive(rows, key)
+    if strategy == 'hash':
+        return group_hashed(rows, key)
+    return group_external(rows, key, chunk_size)
+
+
+def unique_rows(rows):
+    seen = set()
+    unique = []
+    for row in rows:
+        if (row_key := tuple(row.items())) not in seen:
+            seen.add(row_key)
+            unique.append(row)
+    return unique
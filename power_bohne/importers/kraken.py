@@ -3,9 +3,9 @@ import csv
 import json
 import requests
 from collections import Counter, defaultdict
-from itertools import groupby
 from datetime import datetime
 from os import path
+from typing import Optional
 from toolz.curried import get
 
 from beancount.ingest.importer import ImporterProtocol
@@ -14,7 +14,10 @@ from beancount.core.data import new_metadata, Cost, Posting
 
 from ..utils import Transaction, safe_D, FileCache
 from .crypto_assets import ASSET_TYPES, AssetType
+from .importer_utils import RefidCheckpoint, GROUPING_STRATEGIES, group_rows, unique_rows
 from ..prices import kraken
+from ..prices.kraken_archive import TradeArchive
+from ..prices.oracle import PriceOracle
 
 import logging
 
@@ -42,12 +45,22 @@ KRAKEN_ASSET_REMAP = {
 }
 
 
+SELL_PRICE_LOOKBEHIND = 150
+
+ZERO = safe_D('0')
+
+# @dev ledgers above this size are grouped with an external sort when `refid_grouping='auto'`
+EXTERNAL_GROUPING_THRESHOLD = 256 * 1024 * 1024
+
+
 # @dev based off [reedlaw's importer](https://github.com/reedlaw/beancount_kraken)
 class Importer(ImporterProtocol):
 
     def __init__(self, base_currency, cash_acc, net_cash_in, fiat_acc, stables_acc, crypto_acc,
                  withdrawal_fees, crypto_pnl, forex_pnl, kraken_payee='Kraken',
-                 log_level=logging.INFO, file_dest_root='exports/kraken', explicit_ignore=None):
+                 log_level=logging.INFO, file_dest_root='exports/kraken', explicit_ignore=None,
+                 trade_archive: Optional[TradeArchive] = None, checkpoint: Optional[str] = None,
+                 refid_grouping='consecutive', price_oracle: Optional[PriceOracle] = None):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(log_level)
 
@@ -64,9 +77,22 @@ class Importer(ImporterProtocol):
 
         self.file_dest_root = file_dest_root
         self.explicit_ignore = set() if explicit_ignore is None else explicit_ignore
+        assert refid_grouping == 'auto' or refid_grouping in GROUPING_STRATEGIES, \
+            f'Unknown refid grouping {refid_grouping!r}'
+        self.refid_grouping = refid_grouping
 
         self.unrecognized_assets = defaultdict(int)
-        self.sell_price_cache = FileCache('importer.kraken/sell-price.json')
+        self.sell_price_cache = FileCache(
+            'importer.kraken/sell-price.json',
+            ttl=None  # historic trades never change
+        )
+        self.prefetched_prices = dict()
+        self.trade_archive = trade_archive
+        self.sideless_pairs = set()
+        # @dev when set, sell prices are resolved through the oracle instead of the Trades API
+        self.price_oracle = price_oracle
+        # @dev incremental mode, groups recorded in the checkpoint are skipped on later runs
+        self.checkpoint = None if checkpoint is None else RefidCheckpoint(checkpoint)
 
     def name(self) -> str:
         return 'Kraken'
@@ -157,30 +183,111 @@ class Importer(ImporterProtocol):
     def get_sell_price(self, asset, dt):
         timestamp = int(dt.timestamp())
         pair = f'{asset}{self.base_currency}'
+        if (pair, timestamp) in self.prefetched_prices:
+            return self.prefetched_prices[(pair, timestamp)]
+        if self.price_oracle is not None:
+            price_quote = self.price_oracle.get_price(asset, self.base_currency, dt)
+            self.logger.debug(f'Sell price of {pair} at {dt}: '
+                              f'{"none" if price_quote is None else price_quote.source} (oracle)')
+            return None if price_quote is None else price_quote.price
+        if (archived_price := self.get_archived_sell_price(pair, timestamp)) is not None:
+            self.logger.debug(f'Sell price of {pair} at {dt}: trade archive')
+            return archived_price
         if (cached_price := self.sell_price_cache[(pair, timestamp)]) is not None:
+            self.logger.debug(f'Sell price of {pair} at {dt}: cache')
             return safe_D(cached_price)
-        since = timestamp - 150
-        trades, errors = kraken.get_trades(pair, since)
-        if errors:
-            self.logger.error(f'Kraken Trades API returned errors: {errors}')
+        self.logger.debug(f'Sell price of {pair} at {dt}: Kraken API')
+        self.fetch_sell_prices(pair, [timestamp])
+        return self.prefetched_prices[(pair, timestamp)]
+
+    def get_archived_sell_price(self, pair, timestamp):
+        if self.trade_archive is None:
             return None
-        sells = [
-            trade
-            for trade in trades
-            if trade['trade_dir'] == kraken.TradeDirection.Sell
-        ]
-        if not sells:
-            self.logger.error(
-                f'Kraken returned no sells for {pair} (since: {since})'
-            )
+        if self.trade_archive.has_sides(pair) is False:
+            # public dumps have no side column, their trades can't be used as sell prices
+            if pair not in self.sideless_pairs:
+                self.sideless_pairs.add(pair)
+                self.logger.info(f'Trade archive of {pair} has no trade sides, '
+                                 'using the Kraken API for its sell prices')
             return None
+        trade = self.trade_archive.nearest_trade(
+            pair,
+            datetime.fromtimestamp(timestamp),
+            kraken.TradeDirection.Sell,
+            lookbehind=SELL_PRICE_LOOKBEHIND
+        )
+        return None if trade is None else trade.price
+
+    def resolve_sell_prices(self, pair, timestamps) -> dict:
+        '''
+        Nearest sell price for every timestamp, only does network and computation so pairs can be
+        resolved on worker threads.
+        '''
+        trades = kraken.get_nearest_trades(
+            pair,
+            timestamps,
+            kraken.TradeDirection.Sell,
+            SELL_PRICE_LOOKBEHIND
+        )
+        return {
+            timestamp: None if trade is None else trade['price']
+            for timestamp, trade in trades.items()
+        }
+
+    def store_sell_prices(self, pair, resolved):
+        for timestamp, price in resolved.items():
+            if price is not None:
+                self.sell_price_cache[(pair, timestamp)] = float(price)
+            self.prefetched_prices[(pair, timestamp)] = price
+
+    def fetch_sell_prices(self, pair, timestamps):
+        self.store_sell_prices(pair, self.resolve_sell_prices(pair, timestamps))
+
+    def prefetch_sell_prices(self, file):
+        timestamps_by_pair = defaultdict(set)
+        timestamps_by_asset = defaultdict(set)
+        archived = cached = 0
+        for _, transfers, date in self.iter_ledger_groups(file):
+            if transfers[0]['type'] != 'withdrawal':
+                continue
+            kraken_asset = transfers[-1]['asset']
+            asset = KRAKEN_ASSET_REMAP.get(kraken_asset, kraken_asset)
+            if asset == self.base_currency:
+                continue
+            pair = f'{asset}{self.base_currency}'
+            timestamp = int(date.timestamp())
+            if self.price_oracle is not None:
+                timestamps_by_asset[asset].add(timestamp)
+            elif (archived_price := self.get_archived_sell_price(pair, timestamp)) is not None:
+                self.prefetched_prices[(pair, timestamp)] = archived_price
+                archived += 1
+            elif self.sell_price_cache[(pair, timestamp)] is None:
+                timestamps_by_pair[pair].add(timestamp)
+            else:
+                cached += 1
+
+        if self.price_oracle is not None:
+            sources = defaultdict(int)
+            for asset, timestamps in timestamps_by_asset.items():
+                pair = f'{asset}{self.base_currency}'
+                quotes = self.price_oracle.get_prices(asset, self.base_currency, timestamps)
+                for timestamp, price_quote in quotes.items():
+                    sources['none' if price_quote is None else price_quote.source] += 1
+                    self.prefetched_prices[(pair, timestamp)] = \
+                        None if price_quote is None else price_quote.price
+            self.logger.info(f'Sell prices through the oracle: {dict(sources)}')
+            return
 
-        best_sell = min(
-            sells,
-            key=lambda sell: abs(sell['time'].timestamp() - timestamp)
+        self.logger.info(
+            f'Sell prices: {archived} from the trade archive, {cached} cached, '
+            f'{sum(map(len, timestamps_by_pair.values()))} from the Kraken API'
         )
-        self.sell_price_cache[(pair, timestamp)] = float(best_sell['price'])
-        return best_sell['price']
+
+        # pairs are independent, resolve them concurrently within Kraken's rate limit
+        pairs = list(timestamps_by_pair.items())
+        resolved = kraken.CLIENT.map(lambda item: self.resolve_sell_prices(*item), pairs)
+        for (pair, _), pair_resolved in zip(pairs, resolved):
+            self.store_sell_prices(pair, pair_resolved)
 
     def __get_withdrawal_postings(self, withdrawal, meta):
         if (asset := self.__parse_kraken_asset(withdrawal['asset'])) is None:
@@ -217,7 +324,7 @@ class Importer(ImporterProtocol):
                 ),
                 Posting(pnl_account, None, None, None, None, meta)
             ]
-            skip = amount == safe_D('0')
+            skip = amount == ZERO
 
         return postings, 'Withdrawal', skip
 
@@ -276,85 +383,110 @@ class Importer(ImporterProtocol):
             f'Potential Disposal [{withdrawal["date"]}] {refid}: {asset:5} {withdrawal["amount"]}'
         )
 
-    def extract(self, file, _=None) -> list:
-
+    def get_grouping_strategy(self, file):
+        if self.refid_grouping != 'auto':
+            return self.refid_grouping
+        if path.getsize(file.name) > EXTERNAL_GROUPING_THRESHOLD:
+            return 'external'
+        return 'hash'
+
+    def iter_ledger_groups(self, file):
+        # @dev with 'consecutive' grouping the ledger is streamed and only the rows of the current
+        # refid group are held in memory, 'hash' / 'external' also accept unsorted or merged exports
+        strategy = self.get_grouping_strategy(file)
         with open(file.name, 'r', encoding='utf-8') as _file:
-            transactions = list(csv.DictReader(_file))
-
-        entries = []
-
-        transactions_by_ref = groupby(transactions, get('refid'))
-
-        missed_types = Counter()
-
-        for refid, transfers in transactions_by_ref:
-            if refid in self.explicit_ignore:
-                self.logger.debug(f'Skipping {refid}')
-                continue
-
-            transfers = list(transfers)
-            meta = new_metadata(file.name, None)
-            date = datetime.strptime(
-                transfers[0]['time'],
-                '%Y-%m-%d %H:%M:%S'
+            rows = (
+                row
+                for row in csv.DictReader(_file)
+                if row['refid'] != 'refid'  # repeated header of concatenated exports
             )
-            for transfer in transfers:
-                transfer['date'] = date
-            ttype = transfers[0]['type']
-
-            if ttype == 'deposit':
-                if len(transfers) != 1 and not (len(transfers) == 2 and transfers[0]['balance'] == ''):
-                    raise Exception(
-                        f'Unexpected transfer set: {json.dumps(transfers)}'
-                    )
-                deposit = transfers[-1]
-                self.mark_potential_income(deposit, refid)
-                postings, narration, skip = self.__get_deposit_postings(
-                    deposit,
-                    meta
-                )
-            elif ttype == 'withdrawal':
-                if len(transfers) != 1 and not (len(transfers) == 2 and transfers[0]['balance'] == ''):
-                    raise Exception(
-                        f'Unexpected transfer set: {json.dumps(transfers)}'
-                    )
-                withdrawal = transfers[-1]
-                self.mark_potential_disposal(withdrawal, refid)
-                postings, narration, skip = self.__get_withdrawal_postings(
-                    withdrawal,
-                    meta
+            for refid, transfers in group_rows(rows, get('refid'), strategy):
+                if refid in self.explicit_ignore:
+                    self.logger.debug(f'Skipping {refid}')
+                    continue
+
+                if strategy != 'consecutive':
+                    # overlapping exports repeat rows, keep the first copy
+                    transfers = unique_rows(transfers)
+                # @dev Kraken always writes `YYYY-MM-DD HH:MM:SS`, fromisoformat parses that
+                # an order of magnitude faster than strptime
+                date = datetime.fromisoformat(transfers[0]['time'])
+                if self.checkpoint is not None and self.checkpoint.seen(refid, date):
+                    continue
+                for transfer in transfers:
+                    transfer['date'] = date
+                yield refid, transfers, date
+
+    def build_transaction(self, file, refid, transfers, date, missed_types):
+        meta = new_metadata(file.name, None)
+        ttype = transfers[0]['type']
+
+        if ttype == 'deposit':
+            if len(transfers) != 1 and not (len(transfers) == 2 and transfers[0]['balance'] == ''):
+                raise Exception(
+                    f'Unexpected transfer set: {json.dumps(transfers, default=str)}'
                 )
-            elif ttype == 'trade':
-                postings, narration, skip = self.__get_trade_postings(
-                    transfers, meta
+            deposit = transfers[-1]
+            self.mark_potential_income(deposit, refid)
+            postings, narration, skip = self.__get_deposit_postings(
+                deposit,
+                meta
+            )
+        elif ttype == 'withdrawal':
+            if len(transfers) != 1 and not (len(transfers) == 2 and transfers[0]['balance'] == ''):
+                raise Exception(
+                    f'Unexpected transfer set: {json.dumps(transfers, default=str)}'
                 )
-            else:
-                missed_types[ttype] += 1
-                postings = []
-                narration = None
-                skip = False
+            withdrawal = transfers[-1]
+            self.mark_potential_disposal(withdrawal, refid)
+            postings, narration, skip = self.__get_withdrawal_postings(
+                withdrawal,
+                meta
+            )
+        elif ttype == 'trade':
+            postings, narration, skip = self.__get_trade_postings(
+                transfers, meta
+            )
+        else:
+            missed_types[ttype] += 1
+            postings = []
+            narration = None
+            skip = False
 
-            if skip:
-                continue
+        if skip:
+            return None
 
-            if narration is None or not postings:
-                self.logger.error(f'Failed to process {refid} (type: {ttype})')
-                continue
+        if narration is None or not postings:
+            self.logger.error(f'Failed to process {refid} (type: {ttype})')
+            return None
 
-            tx = Transaction(
-                new_metadata(file.name, None, {
-                    'txref': refid,
-                    'time': date.strftime('%H:%M:%S')
-                }),
-                date.date(),
-                '*',  # flag
-                self.payee,
-                narration,
-                frozenset({__name__, 'kraken'}),  # tags
-                frozenset(),  # links
-                postings
-            )
-            entries.append(tx)
+        return Transaction(
+            new_metadata(file.name, None, {
+                'txref': refid,
+                'time': date.strftime('%H:%M:%S')
+            }),
+            date.date(),
+            '*',  # flag
+            self.payee,
+            narration,
+            frozenset({__name__, 'kraken'}),  # tags
+            frozenset(),  # links
+            postings
+        )
+
+    def iter_extract(self, file):
+        self.prefetch_sell_prices(file)
+
+        missed_types = Counter()
+        total_entries = 0
+
+        for refid, transfers, date in self.iter_ledger_groups(file):
+            tx = self.build_transaction(file, refid, transfers, date, missed_types)
+            if tx is not None:
+                total_entries += 1
+                if self.checkpoint is not None:
+                    self.checkpoint.add(refid, date)
+                yield tx
 
         for missed_type, instances in missed_types.items():
             self.logger.error(
@@ -366,11 +498,14 @@ class Importer(ImporterProtocol):
                 f'Unrecognized asset "{asset}" (instances: {instances})'
             )
 
-        self.logger.info(f'Total entries: {len(entries)}')
+        self.logger.info(f'Total entries: {total_entries}')
 
         self.sell_price_cache.save()
+        if self.checkpoint is not None:
+            self.checkpoint.save()
 
-        return entries
+    def extract(self, file, _=None) -> list:
+        return list(self.iter_extract(file))
 
 
 if __name__ == '__main__':
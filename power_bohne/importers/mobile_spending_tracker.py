@@ -3,35 +3,43 @@ import csv
 import logging
 from datetime import datetime
 from collections import namedtuple
-from typing import Optional
+from typing import Optional, Union
 
 from beancount.ingest.importer import ImporterProtocol
 from beancount.core.data import new_metadata, Posting
 from beancount.core.amount import Amount
 
 from ..utils import Transaction, safe_D
+from .account_rules import AccountRules
 
 logging.basicConfig(filename='power-bohne-importers.log',
                     format='[%(name)s] %(levelname)s: %(message)s', level=logging.INFO)
 
 SPENDING_TRACKER_CSV_HEADER = 'Date, Category, Amount, Note'
 DESCRIPTION_FORMAT_PATTERN = r'([^:]+)?:?([^:]+)?>([^:]+)'
+DESCRIPTION_FORMAT_RE = re.compile(DESCRIPTION_FORMAT_PATTERN)
 
 Row = namedtuple(
     'Row',
     ['date', 'category', 'amount', 'payee', 'narration', 'fund_source', 'note']
 )
 
+RowFailure = namedtuple('RowFailure', ['lineno', 'raw_row', 'error'])
+
 
 class Importer(ImporterProtocol):
-    def __init__(self, base_currency, category_accounts: dict[str, str], source_accounts: dict[str, str],
-                 file_dest_root='exports/mobile-spending-tracker', log_level=logging.INFO):
+    def __init__(self, base_currency, category_accounts: Union[dict[str, str], AccountRules],
+                 source_accounts: Union[dict[str, str], AccountRules],
+                 file_dest_root='exports/mobile-spending-tracker', log_level=logging.INFO,
+                 payee_accounts: Optional[AccountRules] = None):
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(log_level)
 
         self.base_currency = base_currency
         self.category_accounts = category_accounts
         self.source_accounts = source_accounts
+        # @dev payee rules take precedence over the category mapping
+        self.payee_accounts = payee_accounts
         self.file_dest_root = file_dest_root
 
     def name(self) -> str:
@@ -47,7 +55,7 @@ class Importer(ImporterProtocol):
         date = datetime.strptime(raw_row['Date'], '%m/%d/%Y').date()
         note = raw_row[' Note']
         category = raw_row[' Category'].strip()
-        if not (m := re.match(DESCRIPTION_FORMAT_PATTERN, note)):
+        if not (m := DESCRIPTION_FORMAT_RE.match(note)):
             raise Exception(f'Failed to parse note {note!r}')
 
         payee, narration, fund_source = m.groups()
@@ -69,12 +77,13 @@ class Importer(ImporterProtocol):
     def _row_to_tx(self, row: Row, file):
         meta = new_metadata(file.name, None)
 
-        main_account = self.category_accounts.get(row.category)
+        main_account = None
+        if self.payee_accounts is not None:
+            main_account = self.payee_accounts.get(row.payee)
         if main_account is None:
-            self.logger.error(
-                f'No account found for category {row.category!r}'
-            )
-            return None
+            main_account = self.category_accounts.get(row.category)
+        if main_account is None:
+            raise ValueError(f'No account found for category {row.category!r}')
 
         main_posting = Posting(
             main_account,
@@ -87,10 +96,7 @@ class Importer(ImporterProtocol):
 
         snd_account = self.source_accounts.get(row.fund_source)
         if snd_account is None:
-            self.logger.error(
-                f'No account found for fund source {row.fund_source!r}'
-            )
-            return None
+            raise ValueError(f'No account found for fund source {row.fund_source!r}')
 
         snd_posting = Posting(
             snd_account,
@@ -116,10 +122,31 @@ class Importer(ImporterProtocol):
 
         )
 
+    def iter_extract(self, file, failures: list[RowFailure]):
+        '''
+        Lazily yields a transaction per row, rows that fail to parse or map to accounts are appended
+        to `failures` and skipped.
+        '''
+        with open(file.name, 'r', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            for raw_row in reader:
+                try:
+                    tx = self._row_to_tx(self._parse_row(raw_row), file)
+                except Exception as err:
+                    failures.append(RowFailure(reader.line_num, raw_row, err))
+                    continue
+                yield tx
+
+    def extract_with_failures(self, file) -> tuple[list, list[RowFailure]]:
+        failures = []
+        entries = list(self.iter_extract(file, failures))
+        return entries, failures
+
     def extract(self, file, _=None) -> list:
-        try:
-            with open(file.name, 'r', encoding='utf-8') as f:
-                rows = list(map(self._parse_row, csv.DictReader(f)))
-            return list(map(lambda row: self._row_to_tx(row, file), rows))
-        except Exception as err:
-            self.logger.error('Exception', exc_info=err)
+        entries, failures = self.extract_with_failures(file)
+        for failure in failures:
+            self.logger.error(
+                f'Failed to import line {failure.lineno} ({failure.raw_row.get(" Note")!r}): '
+                f'{failure.error}'
+            )
+        return entries
@@ -0,0 +1,81 @@
+import os
+import sys
+import runpy
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from beancount.ingest import cache
+from beancount.parser import printer
+from beancount.utils.file_utils import find_files
+from ..prices import kraken, coingecko
+
+logger = logging.getLogger(__name__)
+
+_worker_importers = None
+
+# @dev rate limited API clients, each worker gets its own copy of them
+RATE_LIMITED_CLIENTS = (kraken.CLIENT, coingecko.CLIENT)
+
+
+def _init_worker(importers, workers):
+    global _worker_importers
+    _worker_importers = importers
+    # the workers together must stay within the limits one process was configured for
+    for client in RATE_LIMITED_CLIENTS:
+        client.limiter.split(workers)
+
+
+def _extract_file(task):
+    filename, importer_index = task
+    importer = _worker_importers[importer_index]
+    try:
+        entries = importer.extract(cache.get_file(filename))
+    except Exception as err:
+        logger.error(f'Failed to extract {filename}', exc_info=err)
+        return []
+    return [] if entries is None else entries
+
+
+def identify_files(importers, files_or_directories):
+    tasks = []
+    for filename in sorted(map(os.path.abspath, find_files(files_or_directories))):
+        file = cache.get_file(filename)
+        for importer_index, importer in enumerate(importers):
+            if importer.identify(file):
+                tasks.append((filename, importer_index))
+                break
+        else:
+            logger.info(f'No importer for {filename}')
+    return tasks
+
+
+def entry_sortkey(entry):
+    return entry.date, entry.meta.get('time', '')
+
+
+def extract_files(importers, files_or_directories, max_workers: Optional[int] = None) -> list:
+    '''
+    Extracts every identified file on a process pool and merges the entries by date. Files are
+    processed in sorted order and the merge is stable, so the result doesn't depend on scheduling.
+    Price caches are shared through their SQLite stores which are safe for concurrent processes,
+    API rate limits are split evenly between the workers.
+    '''
+    tasks = identify_files(importers, files_or_directories)
+    if not tasks:
+        return []
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(importers, max_workers)
+    ) as pool:
+        results = list(pool.map(_extract_file, tasks))
+    entries = [entry for file_entries in results for entry in file_entries]
+    return sorted(entries, key=entry_sortkey)
+
+
+if __name__ == '__main__':
+    config_path, *paths = sys.argv[1:]
+    importers = runpy.run_path(config_path)['CONFIG']
+    printer.print_entries(extract_files(importers, paths))
@@ -1,8 +1,30 @@
+import heapq
+from bisect import bisect_left
+from decimal import Context, localcontext, ROUND_HALF_EVEN
+from functools import lru_cache
 from typing import NamedTuple, Optional
-from beancount.core.data import Open, Amount, Posting, Transaction
+from beancount.core.data import Open, Close, Amount, Posting, Transaction, EMPTY_SET, new_metadata
+from beancount.core.flags import FLAG_OKAY
 from beancount.core.number import Decimal
-from datetime import date
-from ..utils import PluginError
+from datetime import date, timedelta
+from ..utils import PluginError, parse_config, get_ledger_index
+
+
+# @dev interest math runs under its own context so it's unaffected by (and doesn't affect) the
+# global one
+INTEREST_CONTEXT = Context(prec=28, rounding=ROUND_HALF_EVEN)
+
+
+@lru_cache(maxsize=None)
+def growth_factor(interest_rate: Decimal, days: int, exact: bool = False) -> Decimal:
+    '''
+    `(1 + interest_rate) ** (days / 365)`, memoized as ledgers only have a few distinct rates and
+    gaps. `exact` computes the exponent in Decimal instead of going through a float.
+    '''
+    growth_rate = Decimal(1) + interest_rate
+    if exact:
+        return growth_rate ** (Decimal(days) / Decimal(365))
+    return growth_rate ** Decimal(days / 365)
 
 
 class InterestAccount:
@@ -13,6 +35,9 @@ class InterestAccount:
     interest_rate: Decimal
     expense_account: str
     income_account: str
+    exact: bool
+    quantum: Optional[Decimal]
+    residual: Decimal
 
     def __init__(
         self,
@@ -22,6 +47,8 @@ class InterestAccount:
         interest_rate: Decimal,
         expense_account: str,
         income_account: str,
+        exact: bool = False,
+        precision: Optional[int] = None
     ) -> None:
         self.account = account
         self.last_updated = last_updated
@@ -30,31 +57,46 @@ class InterestAccount:
         self.interest_rate = interest_rate
         self.expense_account = expense_account
         self.income_account = income_account
+        self.exact = exact
+        self.quantum = None if precision is None else Decimal(1).scaleb(-precision)
+        # interest not booked yet because it's below the precision
+        self.residual = Decimal('0')
 
-    def update_account(self, d: date, post: Posting) -> tuple[Amount, str]:
-        assert post.account == self.account, f'Invalid posting {post} for account {self.account}'
-        assert self.currency == post.units.currency, \
-            f'Account posting currency mismatch {self.currency} != {post.units.currency}'
-        assert post.units.number is not None, f'Post units number is None: {post}'
-
-        amount = post.units.number
-
+    def accrue(self, d: date) -> Decimal:
+        '''Grows the balance up to `d`, returns the interest to book for the elapsed time.'''
         time_passed = d - self.last_updated
 
-        growth_rate = Decimal(1) + self.interest_rate
-        bal_grow = growth_rate ** Decimal(time_passed.days / 365)
+        with localcontext(INTEREST_CONTEXT):
+            bal_grow = growth_factor(self.interest_rate, time_passed.days, self.exact)
 
-        new_bal = self.balance * bal_grow
-        interest = new_bal - self.balance
-        self.balance = new_bal + amount
+            new_bal = self.balance * bal_grow
+            interest = new_bal - self.balance
+            if self.quantum is not None:
+                # book whole units of the precision, the rest is carried into the next period
+                unbooked = interest + self.residual
+                interest = unbooked.quantize(self.quantum)
+                self.residual = unbooked - interest
+                new_bal = self.balance + interest
+            self.balance = new_bal
         self.last_updated = d
+        return interest
 
+    def interest_source_account(self) -> str:
         if self.balance >= 0:
-            interest_source_account = self.income_account
-        else:
-            interest_source_account = self.expense_account
+            return self.income_account
+        return self.expense_account
+
+    def update_account(self, d: date, post: Posting) -> tuple[Amount, str]:
+        assert post.account == self.account, f'Invalid posting {post} for account {self.account}'
+        assert self.currency == post.units.currency, \
+            f'Account posting currency mismatch {self.currency} != {post.units.currency}'
+        assert post.units.number is not None, f'Post units number is None: {post}'
+
+        interest = self.accrue(d)
+        with localcontext(INTEREST_CONTEXT):
+            self.balance = self.balance + post.units.number
 
-        return Amount(interest, self.currency), interest_source_account
+        return Amount(interest, self.currency), self.interest_source_account()
 
 
 _NAMESPACE = 'interest'
@@ -63,6 +105,65 @@ RATE_FIELD = f'{_NAMESPACE}-rate'
 EXPENSE_FIELD = f'{_NAMESPACE}-expense'
 INCOME_FIELD = f'{_NAMESPACE}-income'
 FIELDS = [RATE_FIELD, EXPENSE_FIELD, INCOME_FIELD]
+PRECISION_FIELD = f'{_NAMESPACE}-precision'
+SCHEDULE_FIELD = f'{_NAMESPACE}-schedule'
+
+SCHEDULE_MONTHS = {'monthly': 1, 'quarterly': 3}
+SCHEDULES = ('daily', *SCHEDULE_MONTHS)
+
+EXACT_KEY = 'exact'
+PRECISION_KEY = 'precision'
+
+
+def next_boundary(d: date, schedule: str) -> date:
+    '''First period boundary (start of the next day, month or quarter) after `d`.'''
+    if schedule == 'daily':
+        return d + timedelta(days=1)
+    months = SCHEDULE_MONTHS[schedule]
+    month_index = d.year * 12 + d.month - 1
+    next_index = month_index - month_index % months + months
+    return date(next_index // 12, next_index % 12 + 1, 1)
+
+
+def create_accrual(acc: InterestAccount, d: date, meta) -> Optional[Transaction]:
+    assert d >= acc.last_updated, \
+        f'Accrual for {acc.account} on {d} precedes its last update on {acc.last_updated}'
+    interest = acc.accrue(d)
+    if interest == 0:
+        return None
+    interest_amount = Amount(interest, acc.currency)
+    return Transaction(
+        new_metadata(meta['filename'], meta['lineno']),
+        d,
+        FLAG_OKAY,
+        None,
+        f'Interest accrual ({acc.account})',
+        EMPTY_SET,
+        EMPTY_SET,
+        [
+            Posting(acc.account, interest_amount, None, None, None, None),
+            Posting(acc.interest_source_account(), -interest_amount, None, None, None, None)
+        ]
+    )
+
+
+def accrual_position(entries, d: date) -> int:
+    '''
+    Where an accrual dated `d` goes: after the other directives of that day (balance assertions
+    check the balance at the start of the day) but before its transactions.
+    '''
+    i = bisect_left(entries, d, key=lambda entry: entry.date)
+    while i < len(entries) and entries[i].date == d and not isinstance(entries[i], Transaction):
+        i += 1
+    return i
+
+
+def close_position(entries, close: Close) -> int:
+    '''Position of `close` in `entries`, a final accrual goes right before it.'''
+    i = bisect_left(entries, close.date, key=lambda entry: entry.date)
+    while entries[i] is not close:
+        i += 1
+    return i
 
 
 def continuous_interest_core(entries, options_map, raw_config=None):
@@ -77,52 +178,115 @@ def continuous_interest_core(entries, options_map, raw_config=None):
 
     currency: str = operating_currencies[0]
     assert isinstance(currency, str)
+    config = parse_config(raw_config) if raw_config else {}
+    exact = config.get(EXACT_KEY, 'false').lower() == 'true'
+    default_precision = int(config[PRECISION_KEY]) if PRECISION_KEY in config else None
+    ledger_index = get_ledger_index(entries)
     interest_accounts: dict[str, InterestAccount] = {}
-    for entry in entries:
+    interest_opens: dict[str, Open] = {}
+    schedules: dict[str, str] = {}
+    # @dev scheduled accruals are a heap of `(boundary, seq, account)` merged with the transactions
+    # touching interest accounts in one sweep
+    schedule_heap: list[tuple[date, int, str]] = []
+
+    for entry in ledger_index.open_entries:
         with PluginError.capture_assert(errors, entry=entry):
-            if isinstance(entry, Open):
-                meta = entry.meta
-                field_count = sum([
-                    f in meta
-                    for f in FIELDS
-                ])
-                if field_count == 0:
+            meta = entry.meta
+            field_count = sum([
+                f in meta
+                for f in FIELDS
+            ])
+            if field_count == 0:
+                continue
+            assert field_count == len(FIELDS), \
+                'Entry contains some but not all necessary interest fields'
+            interest_account = entry.account
+            assert interest_account not in interest_accounts, f'Redefining interest account {interest_account}'
+            rate = entry.meta[RATE_FIELD]
+            assert isinstance(rate, Amount), \
+                f'{RATE_FIELD} must be of type Amount'
+            assert rate.currency == 'PERCENT', f'Unsupported unit "{rate.currency}"'
+            assert rate.number is not None, f'Empty number in rate {rate}'
+            precision = entry.meta.get(PRECISION_FIELD, default_precision)
+            assert precision is None or precision == int(precision), \
+                f'{PRECISION_FIELD} must be a whole number of decimal places'
+            schedule = entry.meta.get(SCHEDULE_FIELD)
+            assert schedule is None or schedule in SCHEDULES, \
+                f'{SCHEDULE_FIELD} must be one of {", ".join(SCHEDULES)}'
+
+            interest_accounts[interest_account] = InterestAccount(
+                interest_account,
+                entry.date,
+                currency,
+                rate.number * Decimal('0.01'),
+                entry.meta[EXPENSE_FIELD],
+                entry.meta[INCOME_FIELD],
+                exact,
+                None if precision is None else int(precision)
+            )
+            interest_opens[interest_account] = entry
+            if schedule is not None:
+                schedules[interest_account] = schedule
+                heapq.heappush(
+                    schedule_heap,
+                    (next_boundary(entry.date, schedule), len(schedules), interest_account)
+                )
+
+    accruals: list[tuple[int, Transaction]] = []
+
+    def flush_schedule(until: date):
+        while schedule_heap and schedule_heap[0][0] <= until:
+            boundary, seq, account = heapq.heappop(schedule_heap)
+            if (close := ledger_index.closes.get(account)) is not None and boundary >= close.date:
+                # the period up to the close is booked by the final accrual
+                continue
+            acc = interest_accounts[account]
+            with PluginError.capture_assert(errors, entry=interest_opens[account]):
+                if (accrual := create_accrual(acc, boundary, interest_opens[account].meta)) is not None:
+                    accruals.append((accrual_position(entries, boundary), accrual))
+            heapq.heappush(schedule_heap, (next_boundary(boundary, schedules[account]), seq, account))
+
+    for i in ledger_index.get_transaction_indices(interest_accounts):
+        entry = entries[i]
+        flush_schedule(entry.date)
+        with PluginError.capture_assert(errors, entry=entry):
+            new_postings: list[Posting] = []
+            for post in entry.postings:
+                if (acc := interest_accounts.get(post.account)) is None \
+                        or entry.date < interest_opens[post.account].date:
                     continue
-                assert field_count == len(FIELDS), \
-                    'Entry contains some but not all necessary interest fields'
-                interest_account = entry.account
-                assert interest_account not in interest_accounts, f'Redefining interest account {interest_account}'
-                rate = entry.meta[RATE_FIELD]
-                assert isinstance(rate, Amount), \
-                    f'{RATE_FIELD} must be of type Amount'
-                assert rate.currency == 'PERCENT', f'Unsupported unit "{rate.currency}"'
-                assert rate.number is not None, f'Empty number in rate {rate}'
-
-                interest_accounts[interest_account] = InterestAccount(
-                    interest_account,
+                interest, src_account = acc.update_account(
                     entry.date,
-                    currency,
-                    rate.number * Decimal('0.01'),
-                    entry.meta[EXPENSE_FIELD],
-                    entry.meta[INCOME_FIELD]
+                    post
                 )
-            elif isinstance(entry, Transaction):
-                new_postings: list[Posting] = []
-                for post in entry.postings:
-                    if (acc := interest_accounts.get(post.account)) is None:
-                        continue
-                    interest, src_account = acc.update_account(
-                        entry.date,
-                        post
-                    )
-                    new_postings.extend([
-                        Posting(post.account, interest,
-                                None, None, None, None),
-                        Posting(src_account, -interest, None, None, None, None)
-                    ])
-                entry.postings.extend(new_postings)
-
-    return entries, errors
+                new_postings.extend([
+                    Posting(post.account, interest,
+                            None, None, None, None),
+                    Posting(src_account, -interest, None, None, None, None)
+                ])
+            entry.postings.extend(new_postings)
+
+    if entries:
+        flush_schedule(entries[-1].date)
+    # interest since the last boundary of a closed account is booked on the day it's closed
+    for account in schedules:
+        if (close := ledger_index.closes.get(account)) is None:
+            continue
+        with PluginError.capture_assert(errors, entry=close):
+            if (accrual := create_accrual(interest_accounts[account], close.date, close.meta)) is not None:
+                accruals.append((close_position(entries, close), accrual))
+    if not accruals:
+        return entries, errors
+    accruals.sort(key=lambda position_accrual: position_accrual[0])
+
+    new_entries = []
+    last_position = 0
+    for position, accrual in accruals:
+        new_entries.extend(entries[last_position:position])
+        new_entries.append(accrual)
+        last_position = position
+    new_entries.extend(entries[last_position:])
+    return new_entries, errors
 
 
 __plugins__ = ['continuous_interest_core']
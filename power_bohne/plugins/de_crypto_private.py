@@ -1,13 +1,15 @@
-from functools import reduce
-from toolz import curry, compose
-from beancount.core.getters import get_entry_accounts
+from toolz import curry
 from beancount.core.number import D
-from ..utils import parse_config, get_account_booking_methods, PluginError, Transaction
-from beancount.core import amount, position
-from beancount.core.data import Booking, Transaction as _Transaction, Posting
+from ..utils import parse_config, get_ledger_index, PluginError, Transaction
+from .fifo_lots import FifoLots, LotSplit, EMPTY_SPLIT, LONG_TERM_DAYS, add_splits, format_split, \
+    to_scaled, from_scaled
+from beancount.core import amount
+from beancount.core.data import Booking, Posting
 
+LOT_MODES = ('booked', 'native')
 
-def validate_config(entries, options_map, raw_config):
+
+def validate_config(ledger_index, options_map, raw_config):
     if raw_config is None:
         return None, [PluginError('InvalidConfig: Config empty', options_map['filename'])]
 
@@ -23,7 +25,12 @@ def validate_config(entries, options_map, raw_config):
     if not isinstance(config['acc'], list):
         return None, [PluginError(f'InvalidConfig: \'acc\' must be list, use trailling comma if single item', options_map['filename'])]
 
-    accounts_booking = get_account_booking_methods(entries)
+    config.setdefault('lots', 'booked')
+    if config['lots'] not in LOT_MODES:
+        return None, [PluginError(f'InvalidConfig: \'lots\' must be one of {", ".join(LOT_MODES)}', options_map['filename'])]
+    config['check'] = config.get('check', 'false').lower() == 'true'
+
+    accounts_booking = ledger_index.booking_methods
     for account in config['st'], config['lt'], config['unk'], *config['acc']:
         if account not in accounts_booking:
             return None, [PluginError(f'NonexistentAccount: account \'{account}\' not found', filename=options_map['filename'])]
@@ -35,38 +42,45 @@ def validate_config(entries, options_map, raw_config):
     return config, []
 
 
-def calc_value(position):
-    return amount.Amount(position.cost.number * position.units.number, position.cost.currency)
-
-
-def sum_amounts(amounts, currency):
-    return reduce(
-        amount.add,
-        amounts,
-        amount.Amount(D(0), currency)
+def split_booked_postings(postings, tx_date):
+    '''
+    Units and cost value of the booked disposal postings, in total and split into short- and
+    long-term lots, summed in one pass.
+    '''
+    total_units = st_units = lt_units = D(0)
+    total_value = st_value = lt_value = D(0)
+    for posting in postings:
+        units = posting.units.number
+        value = posting.cost.number * units
+        total_units += units
+        total_value += value
+        if (tx_date - posting.cost.date).days >= LONG_TERM_DAYS:
+            lt_units += units
+            lt_value += value
+        else:
+            st_units += units
+            st_value += value
+    return total_units, total_value, st_units, st_value, lt_units, lt_value
+
+
+def split_native_lots(lot_split: LotSplit):
+    '''`split_booked_postings` of the lots a `FifoLots` reduction consumed.'''
+    def units(scaled): return -from_scaled(scaled)
+    return (
+        units(lot_split.st_units + lot_split.lt_units),
+        -(lot_split.st_value + lot_split.lt_value),
+        units(lot_split.st_units),
+        -lot_split.st_value,
+        units(lot_split.lt_units),
+        -lot_split.lt_value
     )
 
 
-def sum_posting_units(postings, currency):
-    return sum_amounts(map(lambda p: p.units, postings), currency)
-
-
-def calc_total_value(postings, currency):
-    return sum_amounts(map(compose(calc_value, position.get_position), postings), currency)
-
-
-def get_pnl(postings, sub_postings, total_net_gain):
-    asset_currency = postings[0].units.currency
-    base_currency = total_net_gain.currency
-    total_units = sum_posting_units(postings, asset_currency).number
-    total_value = calc_total_value(postings, base_currency).number
-    sub_units = sum_posting_units(sub_postings, asset_currency).number
-    sub_value = calc_total_value(sub_postings, base_currency).number
-
+def get_pnl(total_units, total_value, sub_units, sub_value, total_net_gain):
     return amount.Amount(
         (total_net_gain.number + total_value) *
         sub_units / total_units - sub_value,
-        base_currency
+        total_net_gain.currency
     )
 
 
@@ -91,7 +105,7 @@ def validate_asset_postings(asset_postings, tx):
 
 
 @curry
-def tx_separator(unclassified, crypto_assets_accounts, tx):
+def tx_separator(unclassified, crypto_assets_accounts, tx, split=None):
     asset_postings = []
     value_out_postings = []
     net_gain_value = None
@@ -115,18 +129,22 @@ def tx_separator(unclassified, crypto_assets_accounts, tx):
     if validation_error:
         return None, None, validation_error
 
-    long_term_postings = []
-    short_term_postings = []
     for asset_posting in asset_disposal_postings:
-        if (tx.date - asset_posting.cost.date).days >= 365:
-            long_term_postings.append(asset_posting)
-        else:
-            short_term_postings.append(asset_posting)
-
-    lt_pnl = get_pnl(asset_disposal_postings,
-                     long_term_postings, net_gain_value)
-    st_pnl = get_pnl(asset_disposal_postings,
-                     short_term_postings, net_gain_value)
+        if asset_posting.cost is None or asset_posting.cost.currency != net_gain_value.currency:
+            error = PluginError(
+                f'InvalidPosting: Disposal must be held at cost in {net_gain_value.currency}',
+                asset_posting.meta['filename'], asset_posting.meta['lineno'], tx
+            )
+            return None, None, error
+
+    if split is None:
+        split = split_booked_postings(asset_disposal_postings, tx.date)
+    else:
+        split = split(asset_disposal_postings, tx)
+    total_units, total_value, st_units, st_value, lt_units, lt_value = split
+
+    lt_pnl = get_pnl(total_units, total_value, lt_units, lt_value, net_gain_value)
+    st_pnl = get_pnl(total_units, total_value, st_units, st_value, net_gain_value)
 
     # if there was a tiny rounding error somehow shove into long-term account
     remainder = amount.sub(net_gain_value, amount.add(lt_pnl, st_pnl))
@@ -197,8 +215,83 @@ def insert_pnls(entry, st_pnl, lt_pnl, config):
     return new_entry
 
 
+def de_crypto_private_native(entries, config, ledger_index, separate_tx):
+    '''
+    Splits disposals with the plugin's own FIFO lot book instead of the lots beancount booked. Every
+    transaction touching the asset accounts is replayed in order: postings at cost add lots and
+    reductions consume them. With `check=true` each disposal is compared to beancount's booking.
+    '''
+    crypto_assets_accounts = set(config['acc'])
+    unclassified = config['unk']
+    lots = FifoLots()
+
+    def native_split(disposal_postings, tx):
+        # booking may have split one reduction over several lots, reduce the total per account
+        units_by_account = {}
+        for posting in disposal_postings:
+            units_by_account[posting.account] = \
+                units_by_account.get(posting.account, 0) - to_scaled(posting.units.number)
+        currency = disposal_postings[0].units.currency
+        lot_split = EMPTY_SPLIT
+        for account, units in units_by_account.items():
+            lot_split = add_splits(lot_split, lots.reduce(account, currency, units, tx.date))
+        if config['check']:
+            booked_split = EMPTY_SPLIT
+            for posting in disposal_postings:
+                units = -to_scaled(posting.units.number)
+                value = posting.cost.number * from_scaled(units)
+                if (tx.date - posting.cost.date).days >= LONG_TERM_DAYS:
+                    booked_split = add_splits(booked_split, LotSplit(0, D(0), units, value))
+                else:
+                    booked_split = add_splits(booked_split, LotSplit(units, value, 0, D(0)))
+            assert lot_split == booked_split, \
+                f'LotMismatch: native FIFO lots [{format_split(lot_split)}] differ from the ' \
+                f'booked lots [{format_split(booked_split)}]'
+        return split_native_lots(lot_split)
+
+    for i in ledger_index.get_transaction_indices(crypto_assets_accounts):
+        entry = entries[i]
+        asset_postings = [
+            posting
+            for posting in entry.postings
+            if posting.account in crypto_assets_accounts
+        ]
+        is_disposal = any(posting.account == unclassified for posting in entry.postings)\
+            and any(posting.units.number < 0 for posting in asset_postings)
+        try:
+            if is_disposal:
+                st_pnl, lt_pnl, error = separate_tx(entry, split=native_split)
+                if error:
+                    return entries, [error]
+                entries[i] = insert_pnls(entry, st_pnl, lt_pnl, config)
+            else:
+                for posting in asset_postings:
+                    if posting.units.number < 0:
+                        lots.reduce(
+                            posting.account,
+                            posting.units.currency,
+                            -to_scaled(posting.units.number),
+                            entry.date
+                        )
+            for posting in asset_postings:
+                if posting.units.number > 0:
+                    assert posting.cost is not None, f'Asset posting {posting.account} not held at cost'
+                    lots.add(
+                        posting.account,
+                        posting.units.currency,
+                        to_scaled(posting.units.number),
+                        posting.cost.number,
+                        posting.cost.date
+                    )
+        except AssertionError as e:
+            return entries, [PluginError(e.args[0], entry.meta['filename'], entry.meta['lineno'], entry)]
+
+    return entries, []
+
+
 def de_crypto_private_core(entries, options_map, raw_config=None):
-    config, errors = validate_config(entries, options_map, raw_config)
+    ledger_index = get_ledger_index(entries)
+    config, errors = validate_config(ledger_index, options_map, raw_config)
     if errors or config is None:
         return entries, errors
 
@@ -208,11 +301,13 @@ def de_crypto_private_core(entries, options_map, raw_config=None):
     # create separate_tx method
     separate_tx = tx_separator(unclassified, crypto_assets_accounts)
 
-    for i, entry in enumerate(entries):
-        accounts = set(get_entry_accounts(entry))
-        if not isinstance(entry, _Transaction)\
-                or unclassified not in accounts\
-                or not (crypto_assets_accounts & accounts):
+    if config['lots'] == 'native':
+        return de_crypto_private_native(entries, config, ledger_index, separate_tx)
+
+    for i in ledger_index.get_transaction_indices([unclassified]):
+        entry = entries[i]
+        accounts = {posting.account for posting in entry.postings}
+        if unclassified not in accounts or not (crypto_assets_accounts & accounts):
             continue
 
         st_pnl, lt_pnl, error = separate_tx(entry)
@@ -0,0 +1,76 @@
+from collections import defaultdict, deque, namedtuple
+from datetime import date
+from decimal import Decimal
+
+# @dev units are stored as integers scaled by 10**SCALE (wei precision). Per-unit costs stay exact
+# `Decimal`s since booked costs (e.g. `{{100 EUR}}` over 3 units) can have any number of decimals,
+# values are `units * cost` computed like beancount's booked postings
+SCALE = 18
+LONG_TERM_DAYS = 365
+
+# consumed units and their cost value, split into short- and long-term holdings
+LotSplit = namedtuple('LotSplit', ['st_units', 'st_value', 'lt_units', 'lt_value'])
+EMPTY_SPLIT = LotSplit(0, Decimal(0), 0, Decimal(0))
+
+
+def to_scaled(number: Decimal) -> int:
+    scaled = number.scaleb(SCALE)
+    assert scaled == scaled.to_integral_value(), f'{number} has more than {SCALE} decimals'
+    return int(scaled)
+
+
+def from_scaled(scaled: int) -> Decimal:
+    # drop the scaling's trailing zeros so results keep the precision of their inputs
+    if scaled == 0:
+        return Decimal(0)
+    scale = SCALE
+    while scale > 0 and scaled % 10 == 0:
+        scaled //= 10
+        scale -= 1
+    return Decimal(scaled).scaleb(-scale)
+
+
+def format_split(split: LotSplit) -> str:
+    return f'short-term {from_scaled(split.st_units)} (cost {split.st_value}), ' \
+        f'long-term {from_scaled(split.lt_units)} (cost {split.lt_value})'
+
+
+def add_splits(a: LotSplit, b: LotSplit) -> LotSplit:
+    return LotSplit(*(x + y for x, y in zip(a, b)))
+
+
+class FifoLots:
+    '''
+    FIFO lot book per `(account, currency)`: a deque of `[units, cost, date]` lots in acquisition
+    order. Reductions consume lots from the front, each lot is visited once while it's partially
+    consumed and popped once it's used up so reductions are amortized O(1) per lot.
+    '''
+
+    def __init__(self):
+        self.lots: dict[tuple[str, str], deque] = defaultdict(deque)
+
+    def add(self, account: str, currency: str, units: int, cost: Decimal, acquired: date):
+        self.lots[(account, currency)].append([units, cost, acquired])
+
+    def reduce(self, account: str, currency: str, units: int, on: date) -> LotSplit:
+        lots = self.lots[(account, currency)]
+        st_units = lt_units = 0
+        st_value = lt_value = Decimal(0)
+        remaining = units
+        while remaining > 0:
+            assert lots, f'Reducing {from_scaled(units)} {currency} exceeds the lots in {account}'
+            lot = lots[0]
+            taken = min(lot[0], remaining)
+            value = lot[1] * from_scaled(taken)
+            if (on - lot[2]).days >= LONG_TERM_DAYS:
+                lt_units += taken
+                lt_value += value
+            else:
+                st_units += taken
+                st_value += value
+            if taken == lot[0]:
+                lots.popleft()
+            else:
+                lot[0] -= taken
+            remaining -= taken
+        return LotSplit(st_units, st_value, lt_units, lt_value)
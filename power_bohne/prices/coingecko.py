@@ -1,18 +1,25 @@
 import json
-import requests
+import time
+from collections import defaultdict
+from typing import Optional
 from decimal import Decimal
 from datetime import datetime
-from .prices_utils import Price, get_lin_avg_price
+import numpy as np
+from .prices_utils import Price, PriceSeries, get_lin_avg_price
+from .http_client import HttpClient
+from .series_cache import SeriesCache
+from ..utils import FileCache
 
 COINGECKO_BASE = 'https://api.coingecko.com/api'
 
+# @dev the public API allows 10-30 calls per minute depending on load
+CLIENT = HttpClient(COINGECKO_BASE, rate=0.4, burst=5)
 
-def get(endpoint, params={}, parse_int=None, **kwarg_params):
-    res = requests.get(
-        f'{COINGECKO_BASE}/{endpoint}',
-        {**params, **kwarg_params}
-    )
-    return json.loads(res.text, parse_float=Decimal, parse_int=parse_int)
+
+def get(endpoint, params={}, parse_int=None, parse_float=Decimal, **kwarg_params):
+    res = CLIENT.get(endpoint, {**params, **kwarg_params})
+    res.raise_for_status()
+    return json.loads(res.text, parse_float=parse_float, parse_int=parse_int)
 
 
 def _validate_single_gecko_input(f):
@@ -46,10 +53,59 @@ def get_price_over_range(coin_id, vs_currency, start, end):
     ]
 
 
+@_validate_single_gecko_input
+def get_price_series_over_range(coin_id, vs_currency, start, end) -> PriceSeries:
+    '''`get_price_over_range` parsed straight into a `PriceSeries`, skipping per-point objects.'''
+    res = get(f'v3/coins/{coin_id}/market_chart/range', {
+        'vs_currency': vs_currency,
+        'from': start,
+        'to': end
+    }, parse_int=int, parse_float=float)
+    points = np.array(res.get('prices') or [], dtype=np.float64).reshape(-1, 2)
+    return PriceSeries(points[:, 0].astype(np.int64) * 1000, points[:, 1])
+
+
+def get_many_prices_over_range(queries):
+    '''
+    Concurrent `get_price_over_range` for many `(coin_id, vs_currency, start, end)` queries,
+    results are in input order.
+    '''
+    return CLIENT.map(lambda query: get_price_over_range(*query), queries)
+
+
 HISTORIC_LIN_RADIUS = 12 * 60 * 60
 
 
-def get_historic_lin_avg_price(coin_id, vs_currency, time):
+# @dev CoinGecko returns 5 minute points for ranges of up to a day, coarser ones beyond that
+MAX_FINE_RANGE = 24 * 60 * 60
+SERIES_MERGE_DISTANCE = 2 * 60 * 60
+# @dev CoinGecko returns hourly points for ranges of up to 90 days, daily ones beyond that
+MAX_HOURLY_RANGE = 90 * 24 * 60 * 60
+
+_series_cache = None
+
+
+def get_series_cache() -> SeriesCache:
+    global _series_cache
+    if _series_cache is None:
+        _series_cache = SeriesCache(
+            'prices.coingecko/series.sqlite',
+            get_price_series_over_range,
+            max_fetch_span=MAX_FINE_RANGE,
+            merge_distance=SERIES_MERGE_DISTANCE,
+            max_batch_span=MAX_HOURLY_RANGE
+        )
+    return _series_cache
+
+
+def get_historic_lin_avg_price(coin_id, vs_currency, time, cached=True):
+    if cached:
+        return get_series_cache().get_lin_avg_price(
+            coin_id,
+            vs_currency,
+            time,
+            HISTORIC_LIN_RADIUS
+        )
     prices = get_price_over_range(
         coin_id,
         vs_currency,
@@ -59,12 +115,99 @@ def get_historic_lin_avg_price(coin_id, vs_currency, time):
     return get_lin_avg_price(prices, time)
 
 
+COIN_LIST_REFRESH = 24 * 60 * 60
+# @dev a failed refresh isn't retried for this long, so offline runs don't hit the network per lookup
+COIN_LIST_RETRY = 60 * 60
+# @dev forced refreshes (for ids missing from the list) are skipped if the list is younger than this
+COIN_LIST_MIN_REFRESH = 60 * 60
+COIN_LIST_TIMEOUT = 10.0
+
+
+class CoinIndex:
+    def __init__(self, coins, fetched_at):
+        self.fetched_at = fetched_at
+        self.symbols: dict[str, str] = {}
+        self.ids_by_symbol: dict[str, list[str]] = defaultdict(list)
+        self.ids_by_contract: dict[str, list[tuple[str, str]]] = defaultdict(list)
+        for coin in coins:
+            self.symbols[coin['id']] = coin['symbol']
+            self.ids_by_symbol[coin['symbol'].lower()].append(coin['id'])
+            for platform, address in (coin.get('platforms') or {}).items():
+                if address:
+                    self.ids_by_contract[address.lower()].append((platform, coin['id']))
+
+    def get_ids(self, symbol) -> list[str]:
+        return self.ids_by_symbol.get(symbol.lower(), [])
+
+    def get_id_by_contract(self, address, platform=None) -> Optional[str]:
+        matches = [
+            coin_id
+            for coin_platform, coin_id in self.ids_by_contract.get(address.lower(), [])
+            if platform is None or coin_platform == platform
+        ]
+        return matches[0] if len(matches) == 1 else None
+
+
+_coin_index: Optional[CoinIndex] = None
+_coin_list_failure: Optional[tuple[float, Exception]] = None
+# @dev ids still missing after a refresh, so repeated lookups of them don't refresh again
+_unknown_coin_ids: set[str] = set()
+
+
+def get_coin_index(refresh=False) -> CoinIndex:
+    '''
+    Coin list index persisted in the cache folder and refreshed at most every `COIN_LIST_REFRESH`
+    seconds (or when forced, at most every `COIN_LIST_MIN_REFRESH` seconds), a stale list is kept if
+    refreshing fails. The refresh is a single attempt and after a failure no refresh is tried for
+    `COIN_LIST_RETRY` seconds.
+    '''
+    global _coin_index, _coin_list_failure
+    if _coin_index is None:
+        cached = FileCache('prices.coingecko/coins-list.json').get('coins-list')
+        if cached is not None:
+            _coin_index = CoinIndex(cached['coins'], cached['fetched_at'])
+    stale = _coin_index is None or time.time() - _coin_index.fetched_at > COIN_LIST_REFRESH
+    if refresh and not stale and time.time() - _coin_index.fetched_at < COIN_LIST_MIN_REFRESH:
+        refresh = False
+    if refresh or stale:
+        if _coin_list_failure is not None and time.time() - _coin_list_failure[0] < COIN_LIST_RETRY:
+            if _coin_index is None:
+                raise _coin_list_failure[1]
+            return _coin_index
+        try:
+            res = CLIENT.get(
+                'v3/coins/list',
+                {'include_platform': True},
+                max_retries=0,
+                timeout=COIN_LIST_TIMEOUT
+            )
+            res.raise_for_status()
+            coins = json.loads(res.text)
+        except Exception as err:
+            _coin_list_failure = (time.time(), err)
+            if _coin_index is None:
+                raise
+            return _coin_index
+        _coin_list_failure = None
+        cache = FileCache('prices.coingecko/coins-list.json')
+        cache['coins-list'] = {'fetched_at': time.time(), 'coins': coins}
+        cache.save()
+        _coin_index = CoinIndex(coins, time.time())
+    return _coin_index
+
+
 def get_ticker(coin_id):
-    res = get(f'v3/coins/list', include_platform=True)
-    for asset in res:
-        if asset['id'] == coin_id:
-            return asset['symbol'].upper()
-    raise ValueError(f'No trustworthy ticker found for "{coin_id}"')
+    if (symbol := get_coin_index().symbols.get(coin_id)) is None and coin_id not in _unknown_coin_ids:
+        # the id may be newer than the local list
+        symbol = get_coin_index(refresh=True).symbols.get(coin_id)
+    if symbol is None:
+        _unknown_coin_ids.add(coin_id)
+        raise ValueError(f'No trustworthy ticker found for "{coin_id}"')
+    return symbol.upper()
+
+
+def get_coin_id_by_contract(address, platform=None) -> Optional[str]:
+    return get_coin_index().get_id_by_contract(address, platform)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+import time
+import random
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from typing import Callable, Iterable, Optional
+
+
+class RateLimiter:
+    '''Thread-safe token bucket: `rate` requests per second with bursts of up to `burst`.'''
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def split(self, parts: int):
+        '''Keeps `1 / parts` of the rate and burst, for `parts` processes sharing one upstream limit.'''
+        with self.lock:
+            self.rate /= parts
+            self.burst = max(1, self.burst // parts)
+            self.tokens = min(self.tokens, self.burst)
+
+    def backoff(self, delay: float):
+        # @dev drains the bucket so every thread sharing it pauses after a throttle response
+        with self.lock:
+            self.tokens = min(self.tokens, 1 - delay * self.rate)
+
+
+class HttpClient:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url: str, rate: float, burst: int = 1, max_retries: int = 5,
+                 backoff: float = 1.0, max_backoff: float = 60.0, max_workers: int = 4,
+                 timeout: float = 30.0):
+        self.base_url = base_url
+        self.limiter = RateLimiter(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def retry_delay(self, attempt: int, res: Optional[requests.Response] = None) -> float:
+        if res is not None and (retry_after := res.headers.get('Retry-After', '')).isdigit():
+            return min(float(retry_after), self.max_backoff)
+        return min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1.0)
+
+    def get(self, endpoint: str, params: Optional[dict] = None,
+            should_retry: Optional[Callable[[requests.Response], bool]] = None,
+            max_retries: Optional[int] = None, timeout: Optional[float] = None) -> requests.Response:
+        '''
+        Rate limited GET, retried with exponential backoff on connection errors, 429 / 5xx
+        responses and responses `should_retry` flags (for APIs reporting throttling in the body).
+        `max_retries` and `timeout` override the client's defaults for this request.
+        '''
+        url = f'{self.base_url}/{endpoint}'
+        max_retries = self.max_retries if max_retries is None else max_retries
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(max_retries + 1):
+            self.limiter.acquire()
+            try:
+                res = self.session.get(url, params=params, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == max_retries:
+                    raise
+                time.sleep(self.retry_delay(attempt))
+                continue
+            throttled = res.status_code in self.RETRY_STATUSES \
+                or (should_retry is not None and should_retry(res))
+            if not throttled or attempt == max_retries:
+                return res
+            delay = self.retry_delay(attempt, res)
+            self.limiter.backoff(delay)
+            time.sleep(delay)
+        raise AssertionError('unreachable')
+
+    def map(self, fn: Callable, items: Iterable) -> list:
+        '''Applies `fn` to all items on a bounded thread pool, results are in input order.'''
+        items = list(items)
+        if len(items) <= 1:
+            return list(map(fn, items))
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as pool:
+            return list(pool.map(fn, items))
@@ -1,7 +1,15 @@
-import requests
+import logging
+from bisect import bisect_left
 from datetime import datetime
 from decimal import Decimal
 from enum import Enum
+from typing import Optional
+from .http_client import HttpClient
+
+logger = logging.getLogger(__name__)
+
+# @dev Kraken's public endpoints allow roughly one call per second
+CLIENT = HttpClient('https://api.kraken.com/0/public', rate=1.0, burst=2)
 
 
 class TradeDirection(Enum):
@@ -28,14 +36,26 @@ def to_order_type(order_type_char):
     return OrderType.Limit
 
 
+def is_throttled(res):
+    # @dev Kraken reports rate limiting with a 200 status and an error in the body
+    try:
+        errors = res.json().get('error', [])
+    except ValueError:
+        return False
+    return any('Too many requests' in error for error in errors)
+
+
 def get_trades(pair, since=None):
-    raw_res = requests.get('https://api.kraken.com/0/public/Trades', {
+    res = CLIENT.get('Trades', {
         'pair': pair,
         'since': since
-    }).json()
+    }, should_retry=is_throttled)
+    try:
+        raw_res = res.json()
+    except ValueError:
+        return [], [f'HTTP {res.status_code}: {res.text[:200]}']
     if 'result' not in raw_res:
-        print(f'pair: {pair}')
-        print(f'raw_res: {raw_res}')
+        return [], raw_res.get('error') or [f'HTTP {res.status_code}: no result for {pair}']
     results = next(iter(raw_res['result'].values()))
     return [
         {
@@ -51,6 +71,68 @@ def get_trades(pair, since=None):
     ], raw_res['error']
 
 
+def get_many_trades(queries):
+    '''Concurrent `get_trades` for many `(pair, since)` queries, results are in input order.'''
+    return CLIENT.map(lambda query: get_trades(*query), queries)
+
+
+def nearest_index(times, target, lo=0):
+    # @dev on ties prefers the earliest entry, matching `min` over a time-ordered list
+    idx = bisect_left(times, target, lo)
+    best = None
+    if idx > lo:
+        best = bisect_left(times, times[idx - 1], lo)
+    if idx < len(times) and (best is None or times[idx] - target < target - times[best]):
+        best = idx
+    return best
+
+
+def get_nearest_trades(pair, timestamps, trade_dir: Optional[TradeDirection] = None,
+                       lookbehind: int = 0) -> dict:
+    '''
+    Nearest trade (of `trade_dir` if given) at or after `timestamp - lookbehind` for every
+    timestamp, `None` where none was found. Uses as few Trades API calls as possible: each response
+    window (~1000 trades) resolves all later timestamps it still brackets with a matching trade.
+    '''
+    timestamps = sorted(set(timestamps))
+    resolved = dict()
+    i = 0
+    while i < len(timestamps):
+        since = timestamps[i] - lookbehind
+        trades, errors = get_trades(pair, since)
+        if errors:
+            logger.error(f'Kraken Trades API returned errors: {errors}')
+            resolved[timestamps[i]] = None
+            i += 1
+            continue
+        matches = sorted(
+            (
+                trade
+                for trade in trades
+                if trade_dir is None or trade['trade_dir'] == trade_dir
+            ),
+            key=lambda trade: trade['time']
+        )
+        if not matches:
+            logger.error(f'Kraken returned no matching trades for {pair} (since: {since})')
+            resolved[timestamps[i]] = None
+            i += 1
+            continue
+
+        match_times = [trade['time'].timestamp() for trade in matches]
+        window_start = i
+        while i < len(timestamps):
+            timestamp = timestamps[i]
+            # later timestamps need a trade after them in the window, otherwise a closer one may
+            # only be in the next window
+            if i != window_start and match_times[-1] < timestamp:
+                break
+            lo = bisect_left(match_times, timestamp - lookbehind)
+            resolved[timestamp] = matches[nearest_index(match_times, timestamp, lo)]
+            i += 1
+    return resolved
+
+
 if __name__ == '__main__':
     trades, _ = get_trades('XBTUSD', since=1595840660)
     print(f'trades: {trades}')
@@ -0,0 +1,234 @@
+import os
+import csv
+import sys
+import json
+import mmap
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional
+from .kraken import TradeDirection
+from ..utils import FileCache
+
+# @dev fixed-point precision prices are stored with, the per-pair `decimals` in the meta file is
+# what the input actually used and is what prices are returned with
+PRICE_DECIMALS = 10
+MICROS = 1_000_000
+
+UNKNOWN_SIDE = 0
+SIDE_FLAGS = {'b': TradeDirection.Buy.value, 's': TradeDirection.Sell.value}
+
+ArchivedTrade = namedtuple('ArchivedTrade', ['price', 'time', 'trade_dir'])
+
+
+def parse_fixed_price(raw_price: str) -> tuple[int, int]:
+    whole, _, frac = raw_price.strip().partition('.')
+    assert len(frac) <= PRICE_DECIMALS, f'Price {raw_price!r} exceeds {PRICE_DECIMALS} decimals'
+    return int(whole + frac.ljust(PRICE_DECIMALS, '0')), len(frac)
+
+
+class ArchivedSeries:
+    '''
+    Read-only, memory-mapped view of one pair's trades: int64 timestamps (µs), int64 fixed-point
+    prices and int8 side flags, all sorted by time.
+    '''
+
+    def __init__(self, base_path: str, meta: dict):
+        self.meta = meta
+        self.count = meta['count']
+        self.decimals = meta['decimals']
+        self.has_sides = meta['has_sides']
+        self._maps = []
+        self.times = self._map(f'{base_path}.time', 'q', 8)
+        self.prices = self._map(f'{base_path}.price', 'q', 8)
+        self.sides = self._map(f'{base_path}.side', 'b', 1)
+
+    def _map(self, fp, fmt, size):
+        if self.count == 0:
+            return memoryview(b'').cast(fmt)
+        with open(fp, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return memoryview(mapped)[:self.count * size].cast(fmt)
+
+    def close(self):
+        for view in (self.times, self.prices, self.sides):
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
+
+    def covers(self, time_us: int) -> bool:
+        return self.count > 0 and self.times[0] <= time_us <= self.times[self.count - 1]
+
+    def _matches(self, i, side):
+        return side is None or self.sides[i] == side
+
+    def nearest_index(self, time_us: int, side: Optional[int] = None,
+                      lookbehind_us: Optional[int] = None, max_distance_us: Optional[int] = None):
+        # @dev walks outwards from the binary search position, closest trade first (ties go to
+        # the earlier trade)
+        if side is not None and not self.has_sides:
+            # without a side column any trade could be on the wrong side
+            return None
+        lo = 0 if lookbehind_us is None else bisect_left(self.times, time_us - lookbehind_us)
+        right = bisect_left(self.times, time_us, lo)
+        left = right - 1
+        while left >= lo or right < self.count:
+            left_dist = time_us - self.times[left] if left >= lo else None
+            right_dist = self.times[right] - time_us if right < self.count else None
+            if right_dist is None or (left_dist is not None and left_dist <= right_dist):
+                i, dist, left = left, left_dist, left - 1
+            else:
+                i, dist, right = right, right_dist, right + 1
+            if max_distance_us is not None and dist > max_distance_us:
+                return None
+            if self._matches(i, side):
+                return i
+        return None
+
+    def get_trade(self, i) -> ArchivedTrade:
+        scaled = self.prices[i] // 10 ** (PRICE_DECIMALS - self.decimals)
+        side = self.sides[i]
+        return ArchivedTrade(
+            Decimal(scaled).scaleb(-self.decimals),
+            datetime.fromtimestamp(self.times[i] / MICROS),
+            TradeDirection(side) if side != UNKNOWN_SIDE else None
+        )
+
+
+class TradeArchive:
+    '''
+    Offline store of Kraken's historic trade dumps (`timestamp,price,volume[,side]` CSVs). Dumps
+    without a side column can't tell buys from sells, side-filtered lookups on such pairs find
+    nothing so callers fall back to a source that can.
+    '''
+    FOLDER = os.path.join(FileCache.CACHE_FOLDER, 'prices.kraken-archive')
+    MAX_DISTANCE = 24 * 60 * 60
+
+    def __init__(self, folder: Optional[str] = None):
+        self.folder = self.FOLDER if folder is None else folder
+        self.series: dict[str, Optional[ArchivedSeries]] = {}
+
+    def __getstate__(self):
+        # @dev memory maps don't pickle, they're reopened on first use
+        return {**self.__dict__, 'series': {}}
+
+    def base_path(self, pair):
+        return os.path.join(self.folder, pair)
+
+    def load_meta(self, pair) -> Optional[dict]:
+        meta_path = f'{self.base_path(pair)}.json'
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r') as f:
+            return json.load(f)
+
+    def open(self, pair) -> Optional[ArchivedSeries]:
+        if pair not in self.series:
+            meta = self.load_meta(pair)
+            self.series[pair] = None if meta is None else ArchivedSeries(self.base_path(pair), meta)
+        return self.series[pair]
+
+    def has_sides(self, pair) -> Optional[bool]:
+        '''Whether the pair's archive records trade sides, None if there's no archive for it.'''
+        series = self.open(pair)
+        return None if series is None else series.has_sides
+
+    def close(self):
+        for series in self.series.values():
+            if series is not None:
+                series.close()
+        self.series = {}
+
+    def ingest_csv(self, pair, csv_path) -> int:
+        '''
+        Appends the trades of a time-sorted dump. Trades at or before the archive's last timestamp
+        are skipped so overlapping or repeated dumps can be ingested safely.
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        base_path = self.base_path(pair)
+        meta = self.load_meta(pair) or {'count': 0, 'decimals': 0, 'has_sides': None}
+        last_time = None
+        if meta['count']:
+            with open(f'{base_path}.time', 'rb') as f:
+                f.seek((meta['count'] - 1) * 8)
+                last_time = array('q', f.read(8))[0]
+        if pair in self.series:
+            self.series.pop(pair).close()
+
+        files = {
+            ext: open(f'{base_path}.{ext}', 'r+b' if os.path.exists(f'{base_path}.{ext}') else 'w+b')
+            for ext in ('time', 'price', 'side')
+        }
+        added = 0
+        try:
+            # drop anything an interrupted ingest wrote past the committed count
+            for ext, size in (('time', 8), ('price', 8), ('side', 1)):
+                files[ext].truncate(meta['count'] * size)
+                files[ext].seek(0, os.SEEK_END)
+            times, prices, sides = array('q'), array('q'), array('b')
+            with open(csv_path, 'r', encoding='utf-8') as f:
+                for row in csv.reader(f):
+                    if not row or not row[0][:1].isdigit():
+                        continue
+                    time_us = round(float(row[0]) * MICROS)
+                    if last_time is not None and time_us < last_time:
+                        if added:
+                            raise ValueError(f'{csv_path} is not sorted by time')
+                        continue
+                    if last_time is not None and time_us == last_time and not added:
+                        continue
+                    price, decimals = parse_fixed_price(row[1])
+                    side = SIDE_FLAGS.get(row[3].strip(), UNKNOWN_SIDE) if len(row) > 3 else UNKNOWN_SIDE
+                    meta['decimals'] = max(meta['decimals'], decimals)
+                    if meta['has_sides'] is None:
+                        meta['has_sides'] = side != UNKNOWN_SIDE
+                    times.append(time_us)
+                    prices.append(price)
+                    sides.append(side)
+                    last_time = time_us
+                    added += 1
+                    if len(times) >= 1 << 16:
+                        times.tofile(files['time'])
+                        prices.tofile(files['price'])
+                        sides.tofile(files['side'])
+                        times, prices, sides = array('q'), array('q'), array('b')
+            times.tofile(files['time'])
+            prices.tofile(files['price'])
+            sides.tofile(files['side'])
+        finally:
+            for f in files.values():
+                f.close()
+
+        meta['count'] += added
+        meta['has_sides'] = bool(meta['has_sides'])
+        tmp_meta_path = f'{base_path}.json.tmp'
+        with open(tmp_meta_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta_path, f'{base_path}.json')
+        return added
+
+    def nearest_trade(self, pair, time: datetime, trade_dir: Optional[TradeDirection] = None,
+                      lookbehind: Optional[float] = None) -> Optional[ArchivedTrade]:
+        if (series := self.open(pair)) is None:
+            return None
+        time_us = round(time.timestamp() * MICROS)
+        if not series.covers(time_us):
+            return None
+        i = series.nearest_index(
+            time_us,
+            None if trade_dir is None else trade_dir.value,
+            None if lookbehind is None else round(lookbehind * MICROS),
+            self.MAX_DISTANCE * MICROS
+        )
+        return None if i is None else series.get_trade(i)
+
+
+if __name__ == '__main__':
+    pair, *csv_paths = sys.argv[1:]
+    archive = TradeArchive()
+    for csv_path in csv_paths:
+        print(f'{csv_path}: {archive.ingest_csv(pair, csv_path)} trades added to {pair}')
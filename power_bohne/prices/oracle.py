@@ -0,0 +1,238 @@
+import json
+import time
+import hashlib
+import logging
+from collections import namedtuple, defaultdict
+from datetime import datetime
+from decimal import Decimal
+from typing import Iterable, Optional
+import numpy as np
+from . import kraken, coingecko
+from .kraken_archive import TradeArchive
+from .prices_utils import MICROS, get_lin_avg_prices
+from ..utils import FileCache
+
+logger = logging.getLogger(__name__)
+
+# `before` / `after` are the distances in seconds to the data points the price was derived from
+PriceQuote = namedtuple('PriceQuote', ['price', 'source', 'before', 'after'])
+
+
+def is_ticker(asset: str) -> bool:
+    return asset.isalnum() and asset.isupper()
+
+
+def trade_dir_name(trade_dir: Optional[kraken.TradeDirection]) -> Optional[str]:
+    return None if trade_dir is None else trade_dir.name
+
+
+class KrakenArchiveProvider:
+    name = 'kraken-archive'
+
+    def __init__(self, archive: Optional[TradeArchive] = None,
+                 trade_dir: Optional[kraken.TradeDirection] = None, lookbehind: Optional[float] = None):
+        self.archive = TradeArchive() if archive is None else archive
+        self.trade_dir = trade_dir
+        self.lookbehind = lookbehind
+
+    @property
+    def config(self):
+        return [self.name, trade_dir_name(self.trade_dir), self.lookbehind]
+
+    def supports(self, asset, quote) -> bool:
+        return is_ticker(asset) and is_ticker(quote)
+
+    def get_quotes(self, asset, quote, timestamps) -> dict[int, PriceQuote]:
+        quotes = dict()
+        for timestamp in timestamps:
+            trade = self.archive.nearest_trade(
+                f'{asset}{quote}',
+                datetime.fromtimestamp(timestamp),
+                self.trade_dir,
+                self.lookbehind
+            )
+            if trade is not None:
+                distance = trade.time.timestamp() - timestamp
+                quotes[timestamp] = PriceQuote(trade.price, self.name, distance, distance)
+        return quotes
+
+
+class KrakenTradesProvider:
+    name = 'kraken'
+
+    def __init__(self, trade_dir: Optional[kraken.TradeDirection] = None, lookbehind: int = 0):
+        self.trade_dir = trade_dir
+        self.lookbehind = lookbehind
+
+    @property
+    def config(self):
+        return [self.name, trade_dir_name(self.trade_dir), self.lookbehind]
+
+    def supports(self, asset, quote) -> bool:
+        return is_ticker(asset) and is_ticker(quote)
+
+    def get_quotes(self, asset, quote, timestamps) -> dict[int, PriceQuote]:
+        trades = kraken.get_nearest_trades(
+            f'{asset}{quote}',
+            timestamps,
+            self.trade_dir,
+            self.lookbehind
+        )
+        quotes = dict()
+        for timestamp, trade in trades.items():
+            if trade is not None:
+                distance = trade['time'].timestamp() - timestamp
+                quotes[timestamp] = PriceQuote(trade['price'], self.name, distance, distance)
+        return quotes
+
+
+class CoinGeckoProvider:
+    '''
+    Interpolated CoinGecko prices. `coin_ids` maps tickers to CoinGecko ids, other assets are
+    assumed to already be ids. Nearby timestamps share one range query through the series cache.
+    '''
+    name = 'coingecko'
+
+    def __init__(self, coin_ids: Optional[dict[str, str]] = None,
+                 radius: float = coingecko.HISTORIC_LIN_RADIUS):
+        self.coin_ids = dict() if coin_ids is None else coin_ids
+        self.radius = radius
+
+    @property
+    def config(self):
+        return [self.name, self.radius, self.coin_ids]
+
+    def supports(self, asset, quote) -> bool:
+        return True
+
+    def get_quotes(self, asset, quote, timestamps) -> dict[int, PriceQuote]:
+        coin_id = self.coin_ids.get(asset, asset)
+        series_cache = coingecko.get_series_cache()
+        quotes = dict()
+        # timestamps whose windows overlap are priced from one series
+        clusters = []
+        for timestamp in sorted(set(timestamps)):
+            if clusters and timestamp - clusters[-1][-1] <= 2 * self.radius:
+                clusters[-1].append(timestamp)
+            else:
+                clusters.append([timestamp])
+        # all windows' gaps are planned together, so nearby clusters share their fetches
+        windows = [(cluster[0] - self.radius, cluster[-1] + self.radius) for cluster in clusters]
+        if not windows:
+            return quotes
+        series_cache.ensure_many(coin_id, quote.lower(), windows)
+        series = series_cache.read_price_series(
+            coin_id,
+            quote.lower(),
+            windows[0][0],
+            windows[-1][1]
+        )
+        # one vectorized pass over all timestamps, points used must lie in the timestamp's window
+        targets = np.array([timestamp for cluster in clusters for timestamp in cluster], dtype=np.int64)
+        bounds = np.array([window for cluster, window in zip(clusters, windows) for _ in cluster])
+        prices, befores, afters = get_lin_avg_prices(series, targets * MICROS)
+        found = ~np.isnan(prices) & (targets + befores >= bounds[:, 0]) & (targets + afters <= bounds[:, 1])
+        for timestamp, price, before, after, ok in zip(targets.tolist(), prices, befores, afters, found):
+            if ok:
+                quotes[timestamp] = PriceQuote(
+                    Decimal(repr(float(price))),
+                    self.name,
+                    float(before),
+                    float(after)
+                )
+        return quotes
+
+
+class PriceOracle:
+    '''
+    Single entry point for `(asset, quote, time) -> PriceQuote` lookups. Resolves through the
+    cache's in-memory LRU, then its persistent store and then `providers` in order, timestamps a
+    provider fails on or has no data for fall through to the next one. Times are truncated to
+    whole seconds.
+
+    Cache keys include a digest of the providers' `config`, so oracles set up differently (e.g.
+    sell-side trades only) can share one file without reading each other's answers.
+    '''
+    # @dev quotes this close to now may still change as providers receive new data
+    STORE_LAG = 60 * 60
+    MEMORY_ENTRIES = 100_000
+
+    def __init__(self, providers: list, fp: str = 'prices.oracle/quotes.json'):
+        self.providers = providers
+        self.config_id = hashlib.sha1(
+            json.dumps([provider.config for provider in providers], sort_keys=True).encode()
+        ).hexdigest()[:16]
+        self.cache = FileCache(fp, max_entries=self.MEMORY_ENTRIES)
+
+    def get_price(self, asset, quote, dt: datetime) -> Optional[PriceQuote]:
+        timestamp = int(dt.timestamp())
+        return self.get_prices(asset, quote, [timestamp])[timestamp]
+
+    def get_prices(self, asset, quote, times: Iterable) -> dict[int, Optional[PriceQuote]]:
+        '''Batch lookup, accepts datetimes or unix timestamps and returns quotes by timestamp.'''
+        timestamps = {
+            int(t.timestamp()) if isinstance(t, datetime) else int(t)
+            for t in times
+        }
+        quotes = dict()
+        missing = []
+        stored = False
+        for timestamp in sorted(timestamps):
+            if (cached := self.cache[(self.config_id, asset, quote, timestamp)]) is not None:
+                price, source, before, after = cached
+                quotes[timestamp] = PriceQuote(Decimal(price), source, before, after)
+            else:
+                missing.append(timestamp)
+
+        for provider in self.providers:
+            if not missing:
+                break
+            if not provider.supports(asset, quote):
+                continue
+            try:
+                resolved = provider.get_quotes(asset, quote, missing)
+            except Exception as err:
+                logger.warning(f'{provider.name} failed for {asset}/{quote}: {err!r}')
+                continue
+            store_until = time.time() - self.STORE_LAG
+            for timestamp, price_quote in resolved.items():
+                quotes[timestamp] = price_quote
+                if timestamp < store_until:
+                    stored = True
+                    self.cache[(self.config_id, asset, quote, timestamp)] = [
+                        str(price_quote.price),
+                        price_quote.source,
+                        price_quote.before,
+                        price_quote.after
+                    ]
+            missing = [timestamp for timestamp in missing if timestamp not in resolved]
+
+        if stored:
+            self.cache.save()
+        return {timestamp: quotes.get(timestamp) for timestamp in timestamps}
+
+    def get_many_prices(self, queries: Iterable[tuple]) -> dict[tuple, Optional[PriceQuote]]:
+        '''`get_prices` for `(asset, quote, time)` queries, grouped per pair.'''
+        by_pair = defaultdict(list)
+        for asset, quote, t in queries:
+            by_pair[(asset, quote)].append(t)
+        return {
+            (asset, quote, timestamp): price_quote
+            for (asset, quote), times in by_pair.items()
+            for timestamp, price_quote in self.get_prices(asset, quote, times).items()
+        }
+
+
+_default_oracle: Optional[PriceOracle] = None
+
+
+def get_default_oracle() -> PriceOracle:
+    '''Shared oracle: local Kraken trade archive, then Kraken's Trades API, then CoinGecko.'''
+    global _default_oracle
+    if _default_oracle is None:
+        _default_oracle = PriceOracle([
+            KrakenArchiveProvider(),
+            KrakenTradesProvider(),
+            CoinGeckoProvider()
+        ])
+    return _default_oracle
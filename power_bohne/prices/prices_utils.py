@@ -1,33 +1,187 @@
+from bisect import bisect_left, bisect_right
 from collections import namedtuple
+from datetime import datetime
 from decimal import Decimal
+import numpy as np
 
 Price = namedtuple('Price', ['price', 'time'])
 
 
+MICROS = 1_000_000
+
+
+def to_micros(time: datetime) -> int:
+    return round(time.timestamp() * MICROS)
+
+
+def as_micros(targets) -> np.ndarray:
+    targets = list(targets) if not isinstance(targets, np.ndarray) else targets
+    if len(targets) and isinstance(targets[0], datetime):
+        return np.fromiter(map(to_micros, targets), dtype=np.int64, count=len(targets))
+    return np.asarray(targets, dtype=np.int64)
+
+
+class PriceSeries:
+    '''
+    Compact, time-sorted price series: int64 µs timestamps and float64 prices in two parallel
+    arrays (16 bytes per point). Indexing yields `Price` tuples so it can stand in for a list of
+    them, slices and `between` are views that don't copy. `save` writes a single `.npy` file which
+    `load` memory maps read-only, so processes opening the same file share its pages.
+    '''
+    DTYPE = np.dtype([('time', '<i8'), ('price', '<f8')])
+
+    def __init__(self, times, prices):
+        self.times = np.asarray(times, dtype=np.int64)
+        self.prices = np.asarray(prices, dtype=np.float64)
+        assert self.times.shape == self.prices.shape, 'times and prices differ in length'
+
+    @classmethod
+    def from_prices(cls, prices) -> 'PriceSeries':
+        return cls(*series_arrays(prices))
+
+    @classmethod
+    def from_records(cls, records: np.ndarray) -> 'PriceSeries':
+        return cls(records['time'], records['price'])
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PriceSeries(self.times[i], self.prices[i])
+        # @dev repr gives the shortest string round-tripping the float, not its binary expansion
+        return Price(Decimal(repr(float(self.prices[i]))), datetime.fromtimestamp(self.times[i] / MICROS))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def between(self, start: datetime, end: datetime) -> 'PriceSeries':
+        lo = np.searchsorted(self.times, to_micros(start), side='left')
+        hi = np.searchsorted(self.times, to_micros(end), side='right')
+        return self[lo:hi]
+
+    def merge(self, other: 'PriceSeries') -> 'PriceSeries':
+        '''Union of both series, points of `other` replace points of `self` at the same time.'''
+        times = np.concatenate((other.times, self.times))
+        prices = np.concatenate((other.prices, self.prices))
+        # stable sort keeps `other` first among equal times, `unique` keeps the first occurrence
+        order = np.argsort(times, kind='stable')
+        times, prices = times[order], prices[order]
+        _, first = np.unique(times, return_index=True)
+        return PriceSeries(times[first], prices[first])
+
+    def to_records(self) -> np.ndarray:
+        records = np.empty(len(self), dtype=self.DTYPE)
+        records['time'] = self.times
+        records['price'] = self.prices
+        return records
+
+    def save(self, fp: str):
+        np.save(fp, self.to_records(), allow_pickle=False)
+
+    @classmethod
+    def load(cls, fp: str, mmap: bool = True) -> 'PriceSeries':
+        return cls.from_records(np.load(fp, mmap_mode='r' if mmap else None, allow_pickle=False))
+
+
+def series_arrays(prices) -> tuple[np.ndarray, np.ndarray]:
+    '''`(times, prices)` as int64 µs and float64 arrays of a time-sorted sequence of `Price`.'''
+    if isinstance(prices, PriceSeries):
+        return prices.times, prices.prices
+    times = np.fromiter((to_micros(price.time) for price in prices), dtype=np.int64, count=len(prices))
+    values = np.fromiter((float(price.price) for price in prices), dtype=np.float64, count=len(prices))
+    return times, values
+
+
+def get_lin_avg_prices(prices, targets) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Vectorized `get_lin_avg_price`: interpolates all `targets` (datetimes or int64 µs timestamps)
+    against one time-sorted series in a single `searchsorted` pass. Returns float64 arrays of the
+    prices and the distances in seconds to the points before and after, NaN where a target isn't
+    enclosed by the series.
+    '''
+    times, values = series_arrays(prices)
+    targets = as_micros(targets)
+    n = len(times)
+    idx = np.searchsorted(times, targets, side='left')
+    right = np.minimum(idx, n - 1)
+    exact = (idx < n) & (times[right] == targets) if n else np.zeros(len(targets), dtype=bool)
+    inside = (idx > 0) & (idx < n) & ~exact
+
+    price = np.full(len(targets), np.nan)
+    before = np.full(len(targets), np.nan)
+    after = np.full(len(targets), np.nan)
+    price[exact] = values[idx[exact]]
+    before[exact] = after[exact] = 0.0
+
+    hi = idx[inside]
+    t, t1, t2 = targets[inside], times[hi - 1], times[hi]
+    p1, p2 = values[hi - 1], values[hi]
+    price[inside] = (t - t1) * (p2 - p1) / (t2 - t1) + p1
+    before[inside] = (t1 - t) / MICROS
+    after[inside] = (t2 - t) / MICROS
+    return price, before, after
+
+
 def get_lin_avg_price(prices, target):
-    # do binary search
-    left = 0
-    right = len(prices) - 1
-
-    while left <= right:
-        mid = left + (right - left) // 2
-        if prices[mid].time < target:
-            left = mid + 1
-        elif prices[mid].time > target:
-            right = mid - 1
-        else:
-            # target found in list
-            return prices[mid].price, 0, 0
-
-    # The target is not in the list.
-    # Find the closest higher and lower numbers.
-    if left == 0 or right == len(prices) - 1:
-        return None, None, None
+    # same neighbour rule as `get_lin_avg_prices` but with exact Decimal math
+    if isinstance(prices, PriceSeries):
+        i = int(np.searchsorted(prices.times, to_micros(target), side='left'))
     else:
-        p1, t1 = prices[right]
-        p2, t2 = prices[left]
-        t1 = Decimal(t1.timestamp())
-        t2 = Decimal(t2.timestamp())
-        t = Decimal(target.timestamp())
+        i = bisect_left(prices, target, key=lambda price: price.time)
+    if i < len(prices) and prices[i].time == target:
+        return prices[i].price, 0, 0
+    if i == 0 or i == len(prices):
+        return None, None, None
+    p1, t1 = prices[i - 1]
+    p2, t2 = prices[i]
+    t1 = Decimal(t1.timestamp())
+    t2 = Decimal(t2.timestamp())
+    t = Decimal(target.timestamp())
+
+    return ((t - t1) * (p2 - p1) / (t2 - t1) + p1, float(t1 - t), float(t2 - t))
+
+
+class IntervalSet:
+    '''Sorted, disjoint set of closed `[start, end]` intervals.'''
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in intervals:
+            self.add(start, end)
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, end):
+        # first interval that could touch [start, end] and the first one entirely after it
+        lo = bisect_left(self.ends, start)
+        hi = bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+    def covers(self, start, end) -> bool:
+        i = bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
 
-        return ((t - t1) * (p2 - p1) / (t2 - t1) + p1, float(t1 - t), float(t2 - t))
+    def gaps(self, start, end) -> list[tuple]:
+        if start == end:
+            return [] if self.covers(start, end) else [(start, end)]
+        gaps = []
+        i = bisect_left(self.ends, start)
+        cursor = start
+        while i < len(self.starts) and self.starts[i] <= end:
+            if self.starts[i] > cursor:
+                gaps.append((cursor, self.starts[i]))
+            cursor = max(cursor, self.ends[i])
+            i += 1
+        if cursor < end:
+            gaps.append((cursor, end))
+        return gaps
@@ -0,0 +1,132 @@
+import os
+import time
+from datetime import datetime
+from itertools import repeat
+from typing import Callable, Optional
+import numpy as np
+from .prices_utils import PriceSeries, IntervalSet, get_lin_avg_price
+from ..utils import FileCache, connect_sqlite, sqlite_transaction
+
+
+class SeriesCache:
+    '''
+    On-disk price time series per `(asset, quote)` that remembers which time ranges were already
+    fetched. Queries only fetch the uncovered gaps, nearby gaps are coalesced into one request of at
+    most `max_fetch_span` seconds. Batches of ranges spreading further than that are planned with
+    `max_batch_span` instead: any gaps within it share one (coarser) request, so a batch costs a
+    handful of requests rather than one per range.
+
+    `fetch(asset, quote, start, end)` must return the `PriceSeries` of `[start, end]` (seconds),
+    reads hand out `PriceSeries` as well.
+    '''
+    BUSY_TIMEOUT = 60.0
+    # @dev ranges that may still receive new data points aren't marked as covered
+    COVERAGE_LAG = 60 * 60
+
+    def __init__(self, fp: str, fetch: Callable[[str, str, float, float], PriceSeries],
+                 max_fetch_span: float, merge_distance: float = 0,
+                 max_batch_span: Optional[float] = None):
+        self.fp = fp
+        self.fetch = fetch
+        self.max_fetch_span = max_fetch_span
+        self.merge_distance = merge_distance
+        self.max_batch_span = max_fetch_span if max_batch_span is None else max_batch_span
+        self.coverage: dict[tuple[str, str], IntervalSet] = {}
+        db_path = os.path.join(FileCache.CACHE_FOLDER, fp)
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.conn = connect_sqlite(db_path, self.BUSY_TIMEOUT)
+        with sqlite_transaction(self.conn) as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS points (asset TEXT, quote TEXT, time_ms INTEGER, '
+                'price TEXT NOT NULL, PRIMARY KEY (asset, quote, time_ms))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS coverage (asset TEXT, quote TEXT, start REAL, end REAL)'
+            )
+
+    def get_coverage(self, asset, quote) -> IntervalSet:
+        # @dev re-read on every miss, another process may have filled the gap in the meantime
+        return IntervalSet(self.conn.execute(
+            'SELECT start, end FROM coverage WHERE asset = ? AND quote = ?',
+            (asset, quote)
+        ).fetchall())
+
+    def plan_fetches(self, gaps, max_fetch_span=None, merge_distance=None) -> list[tuple[float, float]]:
+        max_fetch_span = self.max_fetch_span if max_fetch_span is None else max_fetch_span
+        merge_distance = self.merge_distance if merge_distance is None else merge_distance
+        fetches = []
+        for start, end in gaps:
+            if fetches and start - fetches[-1][1] <= merge_distance \
+                    and end - fetches[-1][0] <= max_fetch_span:
+                fetches[-1] = (fetches[-1][0], end)
+                continue
+            while end - start > max_fetch_span:
+                fetches.append((start, start + max_fetch_span))
+                start += max_fetch_span
+            fetches.append((start, end))
+        return fetches
+
+    def ensure(self, asset, quote, start, end):
+        self.ensure_many(asset, quote, [(start, end)])
+
+    def ensure_many(self, asset, quote, ranges):
+        '''`ensure` for several ranges at once, gaps across all of them are planned together.'''
+        key = (asset, quote)
+        ranges = list(IntervalSet(ranges))
+        if key in self.coverage and all(self.coverage[key].covers(start, end) for start, end in ranges):
+            return
+        coverage = self.coverage[key] = self.get_coverage(asset, quote)
+        gaps = [gap for start, end in ranges for gap in coverage.gaps(start, end)]
+        if not gaps:
+            return
+        if ranges[-1][1] - ranges[0][0] > self.max_fetch_span:
+            fetches = self.plan_fetches(gaps, self.max_batch_span, self.max_batch_span)
+        else:
+            fetches = self.plan_fetches(gaps)
+        covered_until = time.time() - self.COVERAGE_LAG
+        for fetch_start, fetch_end in fetches:
+            series = self.fetch(asset, quote, fetch_start, fetch_end)
+            with sqlite_transaction(self.conn) as conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO points (asset, quote, time_ms, price) VALUES (?, ?, ?, ?)',
+                    zip(
+                        repeat(asset),
+                        repeat(quote),
+                        (series.times // 1000).tolist(),
+                        map(repr, series.prices.tolist())
+                    )
+                )
+                if (fetch_end := min(fetch_end, covered_until)) > fetch_start:
+                    # re-read under the lock so ranges stored by other processes are kept
+                    coverage = self.get_coverage(asset, quote)
+                    coverage.add(fetch_start, fetch_end)
+                    conn.execute(
+                        'DELETE FROM coverage WHERE asset = ? AND quote = ?',
+                        (asset, quote)
+                    )
+                    conn.executemany(
+                        'INSERT INTO coverage (asset, quote, start, end) VALUES (?, ?, ?, ?)',
+                        [(asset, quote, start, end) for start, end in coverage]
+                    )
+                    self.coverage[key] = coverage
+
+    def get_price_series(self, asset, quote, start, end) -> PriceSeries:
+        self.ensure(asset, quote, start, end)
+        return self.read_price_series(asset, quote, start, end)
+
+    def read_price_series(self, asset, quote, start, end) -> PriceSeries:
+        '''Stored points in `[start, end]` without fetching, for ranges already `ensure`d.'''
+        rows = self.conn.execute(
+            'SELECT time_ms, CAST(price AS REAL) FROM points WHERE asset = ? AND quote = ? '
+            'AND time_ms BETWEEN ? AND ? ORDER BY time_ms',
+            (asset, quote, int(start * 1000), int(end * 1000) + 1)
+        ).fetchall()
+        points = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        return PriceSeries(points[:, 0].astype(np.int64) * 1000, points[:, 1])
+
+    def get_lin_avg_price(self, asset, quote, time: datetime, radius: float):
+        target = time.timestamp()
+        return get_lin_avg_price(
+            self.get_price_series(asset, quote, target - radius, target + radius),
+            time
+        )
@@ -1,9 +1,14 @@
 import os
 import json
+import sqlite3
+import time
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict, namedtuple
 from typing import Any, Optional
 from contextlib import contextmanager
-from beancount.core.data import Open, Transaction as _Transaction
+from beancount.core.data import Open, Close, Transaction as _Transaction
 from beancount.core.number import D, Decimal
+from decimal import InvalidOperation
 
 
 def uncallable_callable(callable_obj):
@@ -30,20 +35,113 @@ def parse_config(config):
 
 
 def safe_D(inp, assert_error=None) -> Decimal:
+    # @dev plain numeric strings (the common case in importers) skip beancount's separator cleanup
+    if isinstance(inp, str):
+        try:
+            return Decimal(inp)
+        except InvalidOperation:
+            pass
+    from_d = D(inp)
     if assert_error is None:
         assert_error = f'{inp} not convertible to decimal'
-    from_d = D(inp)
     assert isinstance(from_d, Decimal), assert_error
     return from_d
 
 
-def get_account_booking_methods(entries):
-    accounts = dict()
-    for entry in entries:
-        if isinstance(entry, Open):
-            accounts[entry.account] = entry.booking
+class LedgerIndex:
+    '''
+    Per-account view of a loaded ledger so plugins only visit the entries touching their accounts:
+    Open / Close directives, booking methods and the sorted indices of the transactions posting to
+    each account. Index lists may also contain transactions that no longer touch the account.
+
+    Only the `id` (and posting count) of every entry is remembered, never the entries themselves.
+    `refresh` compares them with a list to find the transactions replaced or extended since.
+    '''
+
+    @staticmethod
+    def get_entry_keys(entries) -> list[tuple[int, int]]:
+        return [
+            (id(entry), len(entry.postings) if isinstance(entry, _Transaction) else 0)
+            for entry in entries
+        ]
+
+    def __init__(self, entries):
+        self.entry_keys = self.get_entry_keys(entries)
+        self.directive_positions: set[int] = set()
+        self.open_entries: list[Open] = []
+        self.opens: dict[str, Open] = {}
+        self.closes: dict[str, Close] = {}
+        self.account_txs: dict[str, list[int]] = defaultdict(list)
+        for i, entry in enumerate(entries):
+            if isinstance(entry, _Transaction):
+                for account in {posting.account for posting in entry.postings}:
+                    self.account_txs[account].append(i)
+            elif isinstance(entry, Open):
+                self.directive_positions.add(i)
+                self.open_entries.append(entry)
+                self.opens[entry.account] = entry
+            elif isinstance(entry, Close):
+                self.directive_positions.add(i)
+                self.closes[entry.account] = entry
+
+    @property
+    def booking_methods(self) -> dict:
+        return {account: entry.booking for account, entry in self.opens.items()}
+
+    def get_transaction_indices(self, accounts) -> list[int]:
+        '''Sorted indices of the transactions posting to any of `accounts`.'''
+        indices = set()
+        for account in accounts:
+            indices.update(self.account_txs.get(account, ()))
+        return sorted(indices)
+
+    def add_transaction(self, i: int, entry):
+        for account in {posting.account for posting in entry.postings}:
+            txs = self.account_txs[account]
+            pos = bisect_left(txs, i)
+            if pos == len(txs) or txs[pos] != i:
+                txs.insert(pos, i)
 
-    return accounts
+    def refresh(self, entries) -> bool:
+        '''
+        Brings the index up to date with `entries` if only transactions were replaced or extended
+        in place, returns False if it has to be rebuilt instead (entries added, removed or moved, or
+        directives replaced).
+        '''
+        entry_keys = self.get_entry_keys(entries)
+        if entry_keys == self.entry_keys:
+            return True
+        if len(entry_keys) != len(self.entry_keys):
+            return False
+        changed = [i for i, (a, b) in enumerate(zip(entry_keys, self.entry_keys)) if a != b]
+        if any(
+            i in self.directive_positions or not isinstance(entries[i], _Transaction)
+            for i in changed
+        ):
+            return False
+        for i in changed:
+            self.add_transaction(i, entries[i])
+        self.entry_keys = entry_keys
+        return True
+
+
+# @dev one index per load, keyed by the identity of the entries list plugins pass along. It holds
+# no entries (besides Open / Close), so keeping it until the next load doesn't keep a ledger alive
+_ledger_index: Optional[tuple[int, LedgerIndex]] = None
+
+
+def get_ledger_index(entries) -> LedgerIndex:
+    '''
+    `LedgerIndex` of `entries`, shared by the plugins of one load: reused while they pass the same
+    list along, updated for transactions they replaced in place and rebuilt otherwise.
+    '''
+    global _ledger_index
+    if _ledger_index is not None and _ledger_index[0] == id(entries) \
+            and _ledger_index[1].refresh(entries):
+        return _ledger_index[1]
+    index = LedgerIndex(entries)
+    _ledger_index = (id(entries), index)
+    return index
 
 
 class PluginError(Exception):
@@ -87,41 +185,216 @@ class PluginError(Exception):
             ))
 
 
+def connect_sqlite(db_path, timeout):
+    # @dev autocommit connection, writes go through `sqlite_transaction`. WAL lets readers in other
+    # processes continue while one writes
+    conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+@contextmanager
+def sqlite_transaction(conn):
+    # @dev `BEGIN IMMEDIATE` takes SQLite's write lock up front so concurrent processes queue up
+    # (for at most the connection's timeout) instead of interleaving, the commit itself is atomic
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+CacheEntry = namedtuple('CacheEntry', ['value', 'encoded', 'expires_at'])
+
+
 class FileCache:
     CACHE_FOLDER = '.power_bohne_cache'
+    DB_EXTENSION = '.sqlite'
+    BUSY_TIMEOUT = 60.0
 
-    def __init__(self, fp):
+    def __init__(self, fp, max_entries: Optional[int] = None, max_bytes: Optional[int] = None,
+                 ttl: Optional[float] = None):
+        '''
+        Persistent key-value cache. `max_entries` / `max_bytes` bound the in-memory layer with LRU
+        eviction, `ttl` is the default lifetime of an entry in seconds (`None` never expires, e.g.
+        for immutable historic data).
+        '''
         self.fp = fp
-        self.mem_cache = dict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.mem_cache: OrderedDict[Any, CacheEntry] = OrderedDict()
+        self.mem_bytes = 0
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.conn = None
         self.load()
 
+    def __getstate__(self):
+        # @dev connections don't pickle, worker processes reopen the store and start cold in memory
+        state = self.__dict__.copy()
+        state.update(conn=None, mem_cache=OrderedDict(), mem_bytes=0, dirty=set())
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load()
+
+    @property
+    def full_path(self):
+        return os.path.join(self.CACHE_FOLDER, self.fp)
+
+    @property
+    def db_path(self):
+        return os.path.splitext(self.full_path)[0] + self.DB_EXTENSION
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.mem_cache),
+            'bytes': self.mem_bytes
+        }
+
+    @staticmethod
+    def encode_key(key):
+        return json.dumps(key)
+
+    def transaction(self):
+        return sqlite_transaction(self.conn)
+
     def load(self):
-        full_path = os.path.join(self.CACHE_FOLDER, self.fp)
-        self.mem_cache = dict()
-        if not os.path.exists(full_path):
-            os.makedirs(os.path.dirname(full_path), exist_ok=True)
-        else:
-            with open(full_path, 'r') as f:
-                try:
-                    cache_items = json.load(f)
-                    self.mem_cache = dict([
-                        (tuple(key) if isinstance(key, list) else key, value)
-                        for key, value in cache_items
-                    ])
-                except json.decoder.JSONDecodeError:
-                    with open(full_path, 'w') as fw:
-                        fw.write('')  # wipe cache
+        os.makedirs(os.path.dirname(self.full_path), exist_ok=True)
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = connect_sqlite(self.db_path, self.BUSY_TIMEOUT)
+        with self.transaction() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+            )
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(cache)')}
+            if 'expires_at' not in columns:
+                conn.execute('ALTER TABLE cache ADD COLUMN expires_at REAL')
+            self.migrate_json(conn)
+        self.mem_cache = OrderedDict()
+        self.mem_bytes = 0
+        self.dirty = set()
         return self.mem_cache
 
+    def migrate_json(self, conn):
+        # @dev imports caches written by the old whole-file JSON format, runs under the write lock
+        # so only one process consumes the file
+        if not os.path.exists(self.full_path):
+            return
+        with open(self.full_path, 'r') as f:
+            try:
+                cache_items = json.load(f)
+            except json.decoder.JSONDecodeError:
+                # keep the damaged file around rather than wiping it
+                os.replace(self.full_path, f'{self.full_path}.corrupt')
+                return
+        conn.executemany(
+            'INSERT OR IGNORE INTO cache (key, value) VALUES (?, ?)',
+            [
+                (self.encode_key(key), json.dumps(value))
+                for key, value in cache_items
+            ]
+        )
+        os.remove(self.full_path)
+
+    @staticmethod
+    def is_expired(expires_at, now):
+        return expires_at is not None and expires_at <= now
+
+    @staticmethod
+    def entry_size(key, entry):
+        return len(FileCache.encode_key(key)) + len(entry.encoded)
+
+    def _insert_mem(self, key, entry):
+        if key in self.mem_cache:
+            self._drop_mem(key)
+        self.mem_cache[key] = entry
+        self.mem_bytes += self.entry_size(key, entry)
+        self._evict()
+
+    def _drop_mem(self, key):
+        entry = self.mem_cache.pop(key)
+        self.mem_bytes -= self.entry_size(key, entry)
+        return entry
+
+    def _over_bounds(self):
+        return (self.max_entries is not None and len(self.mem_cache) > self.max_entries)\
+            or (self.max_bytes is not None and self.mem_bytes > self.max_bytes)
+
+    def _evict(self):
+        evicted_dirty = []
+        while self.mem_cache and self._over_bounds():
+            key = next(iter(self.mem_cache))
+            entry = self._drop_mem(key)
+            self.evictions += 1
+            if key in self.dirty:
+                self.dirty.discard(key)
+                evicted_dirty.append((key, entry))
+        if evicted_dirty:
+            with self.transaction() as conn:
+                self._upsert(conn, evicted_dirty)
+
+    def _upsert(self, conn, items):
+        # @dev only touches the given keys so entries added by other processes are kept (merge)
+        conn.executemany(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            [
+                (self.encode_key(key), entry.encoded, entry.expires_at)
+                for key, entry in items
+            ]
+        )
+
     def get(self, key):
-        return self.mem_cache.get(key)
+        now = time.time()
+        if (entry := self.mem_cache.get(key)) is not None:
+            if not self.is_expired(entry.expires_at, now):
+                self.mem_cache.move_to_end(key)
+                self.hits += 1
+                return entry.value
+            self._drop_mem(key)
+            self.dirty.discard(key)
+        row = self.conn.execute(
+            'SELECT value, expires_at FROM cache WHERE key = ?',
+            (self.encode_key(key),)
+        ).fetchone()
+        if row is None or self.is_expired(row[1], now):
+            self.misses += 1
+            return None
+        encoded, expires_at = row
+        entry = CacheEntry(json.loads(encoded), encoded, expires_at)
+        self._insert_mem(key, entry)
+        self.hits += 1
+        return entry.value
 
     def __getitem__(self, key):
-        return self.mem_cache.get(key)
+        return self.get(key)
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        if ttl is None:
+            ttl = self.ttl
+        expires_at = None if ttl is None else time.time() + ttl
+        self.dirty.add(key)
+        self._insert_mem(key, CacheEntry(value, json.dumps(value), expires_at))
 
     def __setitem__(self, key, value):
-        self.mem_cache[key] = value
+        self.set(key, value)
 
     def save(self):
-        with open(os.path.join(self.CACHE_FOLDER, self.fp), 'w') as f:
-            json.dump(list(self.mem_cache.items()), f)
+        with self.transaction() as conn:
+            self._upsert(conn, [(key, self.mem_cache[key]) for key in self.dirty])
+            conn.execute(
+                'DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?',
+                (time.time(),)
+            )
+        self.dirty = set()
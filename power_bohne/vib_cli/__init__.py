@@ -3,8 +3,9 @@ from collections import defaultdict
 from .metaquery import metaquery
 from .gecko import gecko
 from .billvoice import billvoice
+from .prices import prices
 
-CMDS = [metaquery, gecko, billvoice]
+CMDS = [metaquery, gecko, billvoice, prices]
 
 COMMAND_ALIASES = {
     alias: cmd.name
@@ -1,32 +1,123 @@
+import sys
+import csv
+import json
+from collections import defaultdict
 from datetime import datetime
 from decimal import Decimal
-from ..prices.coingecko import get_price_now, get_historic_lin_avg_price, get_ticker
+from ..prices.coingecko import get_price_now, get_ticker
+from ..prices.oracle import get_default_oracle
 from .vib_utils import Command, CoreCommand, parse_time
 
 
 def add_gecko_parser(parser):
-    parser.add_argument('currency')
-    parser.add_argument('coin_id')
+    parser.add_argument('currency', nargs='?')
+    parser.add_argument('coin_id', nargs='?')
     parser.add_argument('-t', '--time')
     parser.add_argument('-c', '--precision-currency', default=3, type=int)
     parser.add_argument('-k', '--precision-units', default=6, type=int)
     parser.add_argument('-f', '--format', default='%Y-%m-%d %H:%M:%S')
     parser.add_argument('-v', '--value')
     parser.add_argument('-a', '--amount')
+    parser.add_argument('-b', '--batch', nargs='?', const='-',
+                        help='CSV of `time,coin_id,currency[,value][,amount]` queries (default: stdin)')
+    parser.add_argument('-o', '--output', choices=['csv', 'json'], default='csv')
+
+
+BATCH_FIELDS = [
+    'time', 'coin_id', 'currency', 'ticker', 'price', 'before', 'after', 'value', 'amount', 'error'
+]
+
+
+def read_batch(fp) -> list[dict]:
+    if fp == '-':
+        return list(csv.DictReader(sys.stdin))
+    with open(fp, 'r', encoding='utf-8', newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def price_batch(queries: list[dict]) -> list[dict]:
+    '''
+    Prices all queries through the default oracle, batched per `(coin_id, currency)` so they share
+    its persisted cache and data with single lookups. Results are in query order, rows of unknown
+    coin ids are reported with an `error` instead of aborting the batch.
+    '''
+    by_pair = defaultdict(list)
+    for i, query in enumerate(queries):
+        by_pair[(query['coin_id'].strip(), query['currency'].strip().lower())].append(i)
+
+    oracle = get_default_oracle()
+    results = [None] * len(queries)
+    for (coin_id, currency), indices in by_pair.items():
+        times = [parse_time(queries[i]['time']) for i in indices]
+        try:
+            ticker = get_ticker(coin_id)
+        except ValueError as err:
+            ticker, error, price_quotes = None, str(err), dict()
+        else:
+            error, price_quotes = None, oracle.get_prices(coin_id, currency, times)
+        for i, time in zip(indices, times):
+            query = queries[i]
+            price_quote = price_quotes.get(int(time.timestamp()))
+            price = None if price_quote is None else price_quote.price
+            value = Decimal(query['value']) if query.get('value') else None
+            amount = Decimal(query['amount']) if query.get('amount') else None
+            if price is not None and value is not None and amount is None:
+                amount = value / price
+            elif price is not None and amount is not None and value is None:
+                value = amount * price
+            results[i] = {
+                'time': time,
+                'coin_id': coin_id,
+                'currency': currency.upper(),
+                'ticker': ticker,
+                'price': price,
+                'before': None if price_quote is None else price_quote.before,
+                'after': None if price_quote is None else price_quote.after,
+                'value': value,
+                'amount': amount,
+                'error': error if error is not None or price is not None else 'No price found'
+            }
+    return results
+
+
+def gecko_batch_cmd(args):
+    results = price_batch(read_batch(args.batch))
+    for result in results:
+        result['time'] = result['time'].strftime(args.format)
+        if result['price'] is not None:
+            result['price'] = round(result['price'], args.precision_currency)
+        if result['value'] is not None:
+            result['value'] = round(result['value'], args.precision_currency)
+        if result['amount'] is not None:
+            result['amount'] = round(result['amount'], args.precision_units)
+    if args.output == 'json':
+        json.dump(results, sys.stdout, indent=2, default=str)
+        print()
+    else:
+        writer = csv.DictWriter(sys.stdout, BATCH_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
 
 
 def gecko_cmd(args):
+    if args.batch is not None:
+        return gecko_batch_cmd(args)
+    if args.currency is None or args.coin_id is None:
+        raise ValueError('`currency` and `coin_id` are required outside of batch mode')
     if args.time is None:
         price = get_price_now(args.coin_id, args.currency)
         time = datetime.now()
         method = 'CURRENT'
     else:
-        price, before, after = get_historic_lin_avg_price(
+        price_quote = get_default_oracle().get_price(
             args.coin_id,
-            args.currency,
+            args.currency.lower(),
             time := parse_time(args.time)
         )
-        method = f'LIN_AVG ({before / 60:,.2f} min | +{after / 60:,.2f} min)'
+        if price_quote is None:
+            raise ValueError(f'No price found for "{args.coin_id}" at {time}')
+        price, source, before, after = price_quote
+        method = f'LIN_AVG [{source}] ({before / 60:,.2f} min | +{after / 60:,.2f} min)'
 
     if not isinstance(price, Decimal):
         raise TypeError(f'Resulting price "{price}" not of type Decimal')
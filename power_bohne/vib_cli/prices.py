@@ -0,0 +1,125 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+import beancount.loader
+from beancount.core import account_types
+from beancount.core.amount import Amount
+from beancount.core.data import Commodity, Price, Transaction, new_metadata
+from beancount.parser import options, printer
+from ..prices.oracle import get_default_oracle
+from .vib_utils import Command, CoreCommand
+
+COINGECKO_ID_META = 'coingecko-id'
+
+
+def add_prices_parser(parser: ArgumentParser):
+    parser.add_argument('filepath')
+    parser.add_argument('-q', '--quote', help='defaults to the first operating currency')
+    parser.add_argument('-t', '--time-of-day', default='23:59:59',
+                        help='time of day (local) prices are taken at')
+    parser.add_argument('-d', '--digits', default=8, type=int, help='significant digits')
+    parser.add_argument('--no-holdings', action='store_true',
+                        help='skip end-of-month prices of held commodities')
+
+
+def month_end(d: date) -> date:
+    return (d.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+
+def get_coin_ids(entries) -> dict[str, str]:
+    return {
+        entry.currency: entry.meta[COINGECKO_ID_META]
+        for entry in entries
+        if isinstance(entry, Commodity) and COINGECKO_ID_META in entry.meta
+    }
+
+
+def collect_price_dates(entries, options_map, commodities, holdings=True) -> dict[str, set[date]]:
+    '''
+    Dates each commodity needs a price on: dates of postings held at cost and, if `holdings`, the
+    end of every month (up to today) in which a balance sheet account holds the commodity.
+    '''
+    types = options.get_account_types(options_map)
+    dates = defaultdict(set)
+    balances = defaultdict(Decimal)
+    today = date.today()
+    current_month_end = None
+
+    def add_month_ends(until):
+        nonlocal current_month_end
+        while current_month_end is not None and current_month_end < until \
+                and current_month_end <= today:
+            for currency, balance in balances.items():
+                if balance != 0:
+                    dates[currency].add(current_month_end)
+            current_month_end = month_end(current_month_end + timedelta(days=1))
+
+    for entry in entries:
+        if not isinstance(entry, Transaction):
+            continue
+        if holdings:
+            if current_month_end is None:
+                current_month_end = month_end(entry.date)
+            add_month_ends(entry.date)
+        for posting in entry.postings:
+            currency = posting.units.currency
+            if currency not in commodities:
+                continue
+            if posting.cost is not None:
+                dates[currency].add(entry.date)
+            if account_types.is_balance_sheet_account(posting.account, types):
+                balances[currency] += posting.units.number
+    if holdings:
+        add_month_ends(month_end(today) + timedelta(days=1))
+    return dates
+
+
+def round_significant(price: Decimal, digits: int) -> Decimal:
+    return Decimal(f'{price:.{digits}g}')
+
+
+def prices_cmd(args):
+    entries, errors, options_map = beancount.loader.load_file(args.filepath)
+    if errors:
+        raise errors[0]
+    quote = args.quote or options_map['operating_currency'][0]
+    at = time.fromisoformat(args.time_of_day)
+
+    coin_ids = get_coin_ids(entries)
+    existing = {
+        (entry.currency, entry.date)
+        for entry in entries
+        if isinstance(entry, Price) and entry.amount.currency == quote
+    }
+    price_dates = collect_price_dates(entries, options_map, coin_ids, not args.no_holdings)
+
+    oracle = get_default_oracle()
+    meta = new_metadata('<vib-bohne prices>', 0)
+    new_prices = []
+    for currency, dates in sorted(price_dates.items()):
+        dates = sorted(d for d in dates if (currency, d) not in existing)
+        if not dates:
+            continue
+        timestamps = [int(datetime.combine(d, at).timestamp()) for d in dates]
+        # one batched oracle lookup per commodity, sharing the cache with other price consumers
+        price_quotes = oracle.get_prices(coin_ids[currency], quote.lower(), timestamps)
+        for d, timestamp in zip(dates, timestamps):
+            if (price_quote := price_quotes[timestamp]) is None:
+                print(f'; no price for {currency} on {d}')
+                continue
+            new_prices.append(Price(
+                meta,
+                d,
+                currency,
+                Amount(round_significant(price_quote.price, args.digits), quote)
+            ))
+
+    printer.print_entries(new_prices)
+
+
+prices = Command(
+    'prices',
+    ['px'],
+    CoreCommand(add_prices_parser, prices_cmd)
+)
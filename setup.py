@@ -25,6 +25,8 @@ setup(
     },
     install_requires=[
         'toolz',
+        'numpy',
+        'requests',
         'beancount >= 2.0.0',
         'python-dotenv',
         'eth-abi >= 2.2.0',